@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# FTP upload benchmark: sends one large file and a batch of small files to a local pyftpdlib server with the
+# old settings (8K blocks, one session) and with bigger blocks and several parallel sessions, reporting MB/s
+# and files/s for each.
+#
+#   python3 bench/bench_ftp.py --size 256M --files 500 --sessions 4
+
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import contextlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mpfu
+import servers
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=mpfu.parseSize, default=mpfu.parseSize('256M'), help="Large file size (default 256M)")
+parser.add_argument('--files', type=int, default=500, help="Number of small files (default 500)")
+parser.add_argument('--small-size', type=mpfu.parseSize, default=mpfu.parseSize('16K'), help="Small file size (default 16K)")
+parser.add_argument('--sessions', type=int, default=4, help="--ftp-sessions for the parallel run (default 4)")
+parser.add_argument('--runs', type=int, default=3, help="Uploads per setting; the best run is reported (default 3)")
+parser.add_argument('--progress', action='store_true', help="Render the progress bar (to a discarded buffer) as an interactive run would")
+parser.add_argument('--host', help="Benchmark against an existing FTP server instead of starting a local one")
+parser.add_argument('--port', type=int, default=21)
+parser.add_argument('--user', default='mpfu')
+parser.add_argument('--password', default='mpfu')
+parser.add_argument('--remote', default='', help="Remote directory to upload into (default login directory)")
+bargs = parser.parse_args()
+
+# Run one upload of files with the given mpfu options, returning seconds taken. Sessions are closed first,
+# so every run pays for its logins like a fresh MPFU session would.
+def timedUpload(host, files, mpfuargs):
+    mpfu.args = mpfu.parser.parse_args(mpfuargs)
+    mpfu.ftppool.closeAll()
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ok = mpfu.ftpUpload('ftp', host, bargs.user, bargs.password, os.path.dirname(files[0]), '*',
+                            bargs.remote, files)
+    elapsed = time.monotonic() - start
+    if not ok:
+        sys.exit("upload failed")
+    return elapsed
+
+def main():
+    mpfu.headless = not bargs.progress
+    workdir = tempfile.mkdtemp(prefix='mpfu-bench-')
+    try:
+        if bargs.host:
+            host, mpfu.ftppool.port = bargs.host, bargs.port
+        else:
+            os.mkdir(os.path.join(workdir, 'remote'))
+            host, mpfu.ftppool.port = servers.startFTP(os.path.join(workdir, 'remote'), bargs.user, bargs.password)
+
+        os.mkdir(os.path.join(workdir, 'large'))
+        os.mkdir(os.path.join(workdir, 'small'))
+        large = [os.path.join(workdir, 'large', 'payload.bin')]
+        servers.makeFile(large[0], bargs.size)
+        small = []
+        for i in range(bargs.files):
+            small.append(os.path.join(workdir, 'small', f'file{i:05}.bin'))
+            servers.makeFile(small[-1], bargs.small_size)
+
+        settings = (('8K x1', ['--ftp-block', '8K']),
+                    ('1M x1', ['--ftp-block', '1M']),
+                    (f'1M x{bargs.sessions}', ['--ftp-block', '1M', '--ftp-sessions', str(bargs.sessions)]))
+        for workload, files, size in (('large', large, bargs.size), ('small', small, bargs.files * bargs.small_size)):
+            print(f"{workload}: {len(files)} file(s), {size / 1048576:.0f} MB")
+            for name, mpfuargs in settings:
+                best = min(timedUpload(host, files, mpfuargs) for _ in range(bargs.runs))
+                print(f"  {name:8} {size / best / 1048576:8.1f} MB/s {len(files) / best:9.1f} files/s  (best of {bargs.runs})")
+    finally:
+        mpfu.ftppool.closeAll()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
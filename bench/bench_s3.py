@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# S3 upload benchmark against a local S3 stand-in (moto's threaded server, or any S3-compatible endpoint such as
+# MinIO with --endpoint). Uploads a set of build-artifact-like files with s3Upload at several --s3-threads settings,
+# checks every object arrived with the right size, and reports MB/s and files/s.
+#
+#   python3 bench/bench_s3.py --files 500 --file-size 256K --big-files 2 --big-size 64M
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mpfu
+import servers
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--files', type=int, default=500, help="Number of small files (default 500)")
+parser.add_argument('--file-size', type=mpfu.parseSize, default=mpfu.parseSize('256K'), help="Small file size (default 256K)")
+parser.add_argument('--big-files', type=int, default=2, help="Number of large, multipart files (default 2)")
+parser.add_argument('--big-size', type=mpfu.parseSize, default=mpfu.parseSize('64M'), help="Large file size (default 64M)")
+parser.add_argument('--threads', default='1,10,32', help="Comma separated --s3-threads values to compare (default 1,10,32)")
+parser.add_argument('--endpoint', help="Existing S3-compatible endpoint to use instead of starting moto")
+parser.add_argument('--bucket', default='mpfu-bench')
+bargs = parser.parse_args()
+
+def makePayload(workdir):
+    fileglob = []
+    for i in range(bargs.files):
+        fileglob.append(os.path.join(workdir, f'small-{i:05}.bin'))
+        servers.makeFile(fileglob[-1], bargs.file_size)
+    for i in range(bargs.big_files):
+        fileglob.append(os.path.join(workdir, f'big-{i:02}.bin'))
+        servers.makeFile(fileglob[-1], bargs.big_size)
+    return fileglob
+
+# Every uploaded file must be in the bucket with the local size
+def verify(s3, fileglob):
+    sizes = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bargs.bucket):
+        for obj in page.get('Contents', []):
+            sizes[obj['Key']] = obj['Size']
+    missing = [g for g in fileglob if sizes.get(os.path.basename(g)) != os.path.getsize(g)]
+    if missing:
+        sys.exit(f"{len(missing)} objects missing or wrong size, e.g. {missing[0]}")
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='mpfu-bench-s3-')
+    try:
+        endpoint = bargs.endpoint or servers.startS3()
+
+        fileglob = makePayload(workdir)
+        total = sum(os.path.getsize(g) for g in fileglob)
+        mpfu.headless = True
+
+        for threads in [int(t) for t in bargs.threads.split(',')]:
+            mpfu.args = mpfu.parser.parse_args(['--s3-endpoint', endpoint, '--s3-threads', str(threads)])
+            mpfu.s3_client = None
+            s3 = mpfu.s3Client()
+            try:
+                s3.create_bucket(Bucket=bargs.bucket)
+            except s3.exceptions.BucketAlreadyOwnedByYou:
+                pass
+            start = time.monotonic()
+            if not mpfu.s3Upload(workdir, '*', fileglob, bargs.bucket):
+                sys.exit("upload failed")
+            elapsed = time.monotonic() - start
+            verify(s3, fileglob)
+            print(f"--s3-threads {threads:3}: {total / elapsed / 1048576:8.1f} MB/s {len(fileglob) / elapsed:8.1f} files/s"
+                  f"  ({len(fileglob)} files, {total / 1048576:.0f} MB in {elapsed:.1f}s)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Benchmark suite: starts local stand-ins for every protocol (bench/servers.py: the paramiko SSH/SFTP server, pyftpdlib,
+# moto for S3 and impacket for SMB when it's installed) and runs MPFU's upload paths over standard workloads:
+#
+#   large  one large file (--size, default 1G)
+#   small  many small files (--files of --small-size, default 10000 x 4K)
+#   tree   a deep directory tree (--depth levels, --fanout subdirectories and --tree-files files per directory)
+#
+# Runs go through mpfuFanout like a serverlist upload: large and small with uploadDest (ftpUpload, sftpUpload, scpUpload,
+# smbUpload, s3Upload), tree with dirUploadDest, the per-server path of mpfuDirUpload (SFTP, SCP and SMB; FTP and S3
+# have no directory upload). With --mpfu "--backend asyncio" SFTP and SCP run on the asyncio backend instead.
+# Every run is checked on the server side and reported as MB/s and files/s. Save the results with --save and check a
+# later run against them with --compare, which exits 1 if anything got slower than --tolerance allows.
+#
+#   python3 bench/bench_suite.py --save baseline.json
+#   python3 bench/bench_suite.py --compare baseline.json --tolerance 15
+#   python3 bench/bench_suite.py --protocols ftp,s3 --workloads large --size 256M --mpfu "--ftp-sessions 4"
+
+import io
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import contextlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mpfu
+import servers
+
+PROTOCOLS = ('sftp', 'scp', 'ftp', 's3', 'smb')
+WORKLOADS = ('large', 'small', 'tree')
+USER = 'mpfu'
+PASSWORD = 'mpfu'
+SHARE = 'BENCH'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--protocols', default=','.join(PROTOCOLS), help=f"Comma separated protocols to run (default {','.join(PROTOCOLS)})")
+parser.add_argument('--workloads', default=','.join(WORKLOADS), help=f"Comma separated workloads to run (default {','.join(WORKLOADS)})")
+parser.add_argument('--size', type=mpfu.parseSize, default=mpfu.parseSize('1G'), help="Large file size (default 1G)")
+parser.add_argument('--files', type=int, default=10000, help="Number of small files (default 10000)")
+parser.add_argument('--small-size', type=mpfu.parseSize, default=mpfu.parseSize('4K'), help="Small and tree file size (default 4K)")
+parser.add_argument('--depth', type=int, default=8, help="Tree depth (default 8)")
+parser.add_argument('--fanout', type=int, default=2, help="Subdirectories per tree directory (default 2)")
+parser.add_argument('--tree-files', type=int, default=4, help="Files per tree directory (default 4)")
+parser.add_argument('--runs', type=int, default=1, help="Runs per protocol and workload; the best run is reported (default 1)")
+parser.add_argument('--mpfu', default='', help="Extra MPFU options for every run, e.g. \"--fast --ftp-sessions 4\"")
+parser.add_argument('--save', help="Write the results to this JSON file")
+parser.add_argument('--compare', help="Compare against results saved with --save; exit 1 on a regression")
+parser.add_argument('--tolerance', type=float, default=10, help="Allowed MB/s drop against --compare, in percent (default 10)")
+bargs = parser.parse_args()
+
+# Build the tree workload under path, returning (files, bytes)
+def makeTree(path, depth):
+    os.mkdir(path)
+    for i in range(bargs.tree_files):
+        servers.makeFile(os.path.join(path, f'file{i:03}.bin'), bargs.small_size)
+    files, size = bargs.tree_files, bargs.tree_files * bargs.small_size
+    if depth > 1:
+        for i in range(bargs.fanout):
+            subfiles, subsize = makeTree(os.path.join(path, f'dir{i:02}'), depth - 1)
+            files, size = files + subfiles, size + subsize
+    return files, size
+
+# Create the workloads under workdir. Returns {workload: (local path, fileglob, files, bytes)}.
+def makeWorkloads(workdir, workloads):
+    made = {}
+    if 'large' in workloads:
+        os.mkdir(os.path.join(workdir, 'large'))
+        large = os.path.join(workdir, 'large', 'payload.bin')
+        servers.makeFile(large, bargs.size)
+        made['large'] = (os.path.dirname(large), [large], 1, bargs.size)
+    if 'small' in workloads:
+        os.mkdir(os.path.join(workdir, 'small'))
+        small = []
+        for i in range(bargs.files):
+            small.append(os.path.join(workdir, 'small', f'file{i:05}.bin'))
+            servers.makeFile(small[-1], bargs.small_size)
+        made['small'] = (os.path.dirname(small[0]), small, bargs.files, bargs.files * bargs.small_size)
+    if 'tree' in workloads:
+        files, size = makeTree(os.path.join(workdir, 'tree'), bargs.depth)
+        made['tree'] = (os.path.join(workdir, 'tree'), None, files, size)
+    return made
+
+# Start the servers for protocols, each serving its own directory under workdir. Returns {protocol: (host, root)}
+# with root None for S3, whose objects live in moto. Protocols whose server can't be started are left out.
+def startServers(workdir, protocols):
+    started = {}
+    if 'sftp' in protocols or 'scp' in protocols:
+        root = os.path.join(workdir, 'ssh')
+        os.mkdir(root)
+        host, mpfu.sshpool.port = servers.startSSH(root, USER, PASSWORD)
+        started.update({p: (host, root) for p in ('sftp', 'scp') if p in protocols})
+    if 'ftp' in protocols:
+        root = os.path.join(workdir, 'ftp')
+        os.mkdir(root)
+        host, mpfu.ftppool.port = servers.startFTP(root, USER, PASSWORD)
+        started['ftp'] = (host, root)
+    if 's3' in protocols:
+        started['s3'] = (servers.startS3(), None)
+    if 'smb' in protocols:
+        root = os.path.join(workdir, 'smb')
+        os.mkdir(root)
+        addr = servers.startSMB(root, SHARE, USER, PASSWORD)
+        if addr is None:
+            print("impacket isn't installed, skipping SMB")
+        else:
+            host, mpfu.smbpool.port = addr
+            started['smb'] = (host, root)
+    return started
+
+# Remote directory (bucket for S3) for one run, in the form each protocol's upload expects
+def remoteDir(protocol, name):
+    if protocol == 's3':
+        return name
+    if protocol == 'smb':
+        return f'/{SHARE}/{name}/'
+    return f'{name}/'
+
+# Files and bytes that arrived for one run
+def arrived(protocol, root, name):
+    if protocol == 's3':
+        s3 = mpfu.s3Client()
+        files = size = 0
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=name):
+            files += len(page.get('Contents', []))
+            size += sum(obj['Size'] for obj in page.get('Contents', []))
+        return files, size
+    files = size = 0
+    for walker in os.walk(os.path.join(root, name)):
+        files += len(walker[2])
+        size += sum(os.path.getsize(os.path.join(walker[0], file)) for file in walker[2])
+    return files, size
+
+# Remove what one run uploaded, so the next one starts from an empty destination
+def cleanup(protocol, root, name):
+    if protocol == 's3':
+        s3 = mpfu.s3Client()
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=name):
+            if page.get('Contents'):
+                s3.delete_objects(Bucket=name, Delete={'Objects': [{'Key': obj['Key']} for obj in page['Contents']]})
+        s3.delete_bucket(Bucket=name)
+    else:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+# Upload one workload to one protocol, returning seconds taken. Pools are closed first, so every run pays for its
+# logins like a fresh MPFU session would.
+def timedRun(protocol, host, root, workload, local, fileglob, name):
+    remdir = remoteDir(protocol, name)
+    if protocol == 's3':
+        mpfu.s3Client().create_bucket(Bucket=name)
+    elif workload != 'tree':
+        os.mkdir(os.path.join(root, name))
+    mpfu.sshpool.closeAll()
+    mpfu.ftppool.closeAll()
+    mpfu.smbpool.closeAll()
+    dest = (protocol, '', remdir, '', '') if protocol == 's3' else (protocol, host, remdir, USER, PASSWORD)
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if workload == 'tree':
+            asyncfunc = (lambda conn, d: mpfu.asyncDirUpload(conn, d, local, remdir)) if mpfu.asyncBackend(True) else None
+            results = mpfu.mpfuFanout([dest], lambda d: mpfu.dirUploadDest(d, local, remdir), asyncfunc)
+        else:
+            results = mpfu.mpfuFanout([dest], lambda d: mpfu.uploadDest(d, local, '*', fileglob),
+                                      mpfu.asyncUploadFunc(fileglob))
+    return time.monotonic() - start if results[0][1] else None
+
+def main():
+    protocols = [p for p in bargs.protocols.split(',') if p]
+    workloads = [w for w in bargs.workloads.split(',') if w]
+    for unknown in set(protocols) - set(PROTOCOLS) | set(workloads) - set(WORKLOADS):
+        sys.exit(f"unknown protocol or workload '{unknown}'")
+
+    mpfu.headless = True
+    workdir = tempfile.mkdtemp(prefix='mpfu-bench-suite-')
+    results = {}
+    failed = []
+    try:
+        started = startServers(workdir, protocols)
+        mpfuargs = shlex.split(bargs.mpfu)
+        if 's3' in started:
+            mpfuargs += ['--s3-endpoint', started['s3'][0]]
+        mpfu.args = mpfu.parser.parse_args(mpfuargs)
+        os.mkdir(os.path.join(workdir, 'local'))
+        made = makeWorkloads(os.path.join(workdir, 'local'), workloads)
+
+        print(f"{'':14} {'MB/s':>9} {'files/s':>9} {'seconds':>9}")
+        for workload in workloads:
+            local, fileglob, files, size = made[workload]
+            for protocol in protocols:
+                key = f'{protocol}/{workload}'
+                if protocol not in started:
+                    continue
+                if workload == 'tree' and protocol in ('ftp', 's3'):
+                    print(f"{key:14} {'n/a':>9}")
+                    continue
+                best = None
+                for run in range(bargs.runs):
+                    host, root = started[protocol]
+                    name = f'mpfu-bench-{workload}-{run}'
+                    elapsed = timedRun(protocol, host, root, workload, local, fileglob, name)
+                    if elapsed is not None and arrived(protocol, root, name) != (files, size):
+                        elapsed = None
+                    cleanup(protocol, root, name)
+                    if elapsed is None:
+                        break
+                    best = elapsed if best is None else min(best, elapsed)
+                if best is None:
+                    print(f"{key:14} {'FAILED':>9}")
+                    failed.append(key)
+                    continue
+                results[key] = {'mb_s': size / best / 1048576, 'files_s': files / best, 'seconds': best,
+                                'files': files, 'bytes': size}
+                print(f"{key:14} {results[key]['mb_s']:9.1f} {results[key]['files_s']:9.1f} {best:9.2f}")
+    finally:
+        mpfu.sshpool.closeAll()
+        mpfu.ftppool.closeAll()
+        mpfu.smbpool.closeAll()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if bargs.save:
+        with open(bargs.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if bargs.compare:
+        with open(bargs.compare) as f:
+            baseline = json.load(f)
+        for key in sorted(set(baseline) & set(results)):
+            if results[key]['mb_s'] < baseline[key]['mb_s'] * (1 - bargs.tolerance / 100):
+                print(f"Regression in {key}: {results[key]['mb_s']:.1f} MB/s, was {baseline[key]['mb_s']:.1f} MB/s")
+                failed.append(key)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# SFTP transport benchmark: uploads the same file with paramiko defaults and with the --fast transport profile
+# to a local test server (bench/sftpserver.py, started through bench/servers.py) and reports MB/s for each.
+#
+#   python3 bench/bench_transport.py --size 256M --runs 3
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mpfu
+import servers
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=mpfu.parseSize, default=mpfu.parseSize('256M'), help="Test file size (default 256M)")
+parser.add_argument('--runs', type=int, default=3, help="Uploads per profile; the best run is reported (default 3)")
+parser.add_argument('--host', help="Benchmark against an existing SSH server instead of starting a local one")
+parser.add_argument('--port', type=int, default=22)
+parser.add_argument('--user', default='mpfu')
+parser.add_argument('--password', default='mpfu')
+parser.add_argument('--remote', default='/', help="Remote directory to upload into (default /)")
+bargs = parser.parse_args()
+
+# Run one upload of localfile with the given mpfu options, returning seconds taken
+def timedUpload(host, port, localfile, mpfuargs):
+    mpfu.args = mpfu.parser.parse_args(mpfuargs)
+    mpfu.sshpool.closeAll()
+    sftpc = mpfu.sshpool.sftp(host, bargs.user, bargs.password, port=port)
+    start = time.monotonic()
+    ok = mpfu.sftpUpload('sftp', host, bargs.user, bargs.password, os.path.dirname(localfile),
+                         os.path.basename(localfile), bargs.remote, [localfile], sftpc)
+    elapsed = time.monotonic() - start
+    if not ok:
+        sys.exit("upload failed")
+    return elapsed
+
+def main():
+    mpfu.headless = True
+    workdir = tempfile.mkdtemp(prefix='mpfu-bench-')
+    try:
+        if bargs.host:
+            host, port = bargs.host, bargs.port
+        else:
+            os.mkdir(os.path.join(workdir, 'remote'))
+            host, port = servers.startSSH(os.path.join(workdir, 'remote'), bargs.user, bargs.password)
+        mpfu.sshpool.port = port
+
+        localfile = os.path.join(workdir, 'payload.bin')
+        servers.makeFile(localfile, bargs.size)
+
+        results = {}
+        for name, mpfuargs in (('default', []), ('fast', ['--fast'])):
+            best = min(timedUpload(host, port, localfile, mpfuargs) for _ in range(bargs.runs))
+            results[name] = bargs.size / best / 1048576
+            print(f"{name:8} {results[name]:8.1f} MB/s  (best of {bargs.runs}, {bargs.size / 1048576:.0f} MB)")
+        print(f"fast/default: {results['fast'] / results['default']:.2f}x")
+    finally:
+        mpfu.sshpool.closeAll()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
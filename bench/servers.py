@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Local protocol stand-ins for MPFU benchmarks. Each server runs in its own process, so it doesn't compete with the
+# client for the GIL, and serves a scratch directory (or in-memory buckets for S3). Not for anything but benchmarking.
+# Also makeFile, for the payloads the benchmark scripts upload.
+
+import os
+import sys
+import time
+import logging
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Write a file of random bytes
+def makeFile(path, size):
+    with open(path, 'wb') as f:
+        for _ in range(size // 1048576):
+            f.write(os.urandom(1048576))
+        f.write(os.urandom(size % 1048576))
+
+# Run target(*args, addrqueue) in a daemon process and return what it puts on addrqueue once it is listening
+def inProcess(target, *args):
+    addrqueue = multiprocessing.Queue()
+    multiprocessing.Process(target=target, args=args + (addrqueue,), daemon=True).start()
+    return addrqueue.get(timeout=60)
+
+def serveSSH(root, user, password, addrqueue):
+    import sftpserver
+
+    addrqueue.put(tuple(sftpserver.startServer(root, 0, user, password)))
+    while True:
+        time.sleep(3600)
+
+def serveFTP(root, user, password, addrqueue):
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    from pyftpdlib.log import config_logging
+
+    config_logging(level=logging.ERROR)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(user, password, root, perm='elradfmwMT')
+    handler = type('benchFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    addrqueue.put(server.address[:2])
+    server.serve_forever()
+
+def serveS3(addrqueue):
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    addrqueue.put(server.get_host_and_port())
+    while True:
+        time.sleep(3600)
+
+def serveSMB(root, share, user, password, addrqueue):
+    from impacket import smbserver
+    from impacket.ntlm import compute_lmhash, compute_nthash
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    server = smbserver.SimpleSMBServer(listenAddress='127.0.0.1', listenPort=0)
+    server.addShare(share, root, '')
+    server.setSMB2Support(True)
+    server.addCredential(user, 0, compute_lmhash(password).hex(), compute_nthash(password).hex())
+    server.setSMBChallenge('')
+    addrqueue.put(server.getServer().server_address[:2])
+    server.start()
+
+# SSH server with SFTP and exec (for SCP and tar streams) rooted at root. Returns (host, port).
+def startSSH(root, user='mpfu', password='mpfu'):
+    return inProcess(serveSSH, root, user, password)
+
+# pyftpdlib FTP server rooted at root. Returns (host, port).
+def startFTP(root, user='mpfu', password='mpfu'):
+    return inProcess(serveFTP, root, user, password)
+
+# moto S3 server. Returns the endpoint URL, with dummy AWS credentials set in the environment for boto3.
+def startS3():
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ.setdefault(var, 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    host, port = inProcess(serveS3)
+    return f"http://{host}:{port}"
+
+# impacket SMB server sharing root as share. Returns (host, port), or None if impacket isn't installed.
+def startSMB(root, share='BENCH', user='mpfu', password='mpfu'):
+    try:
+        import impacket
+    except ImportError:
+        return None
+    return inProcess(serveSMB, root, share, user, password)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Local paramiko-based SSH server for MPFU benchmarks. Serves SFTP and exec channels (commands run through the
+# local shell, with absolute paths moved under the root) rooted at a scratch directory, with password authentication
+# only. Not for anything but benchmarking.
+
+import os
+import sys
+import shlex
+import socket
+import subprocess
+import threading
+import paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+# Shared host key for every server started by this process
+host_key = paramiko.RSAKey.generate(2048)
+
+class benchSSHServer(paramiko.ServerInterface):
+
+    def __init__(self, root, username, password):
+        self.root = root
+        self.username = username
+        self.password = password
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username == self.username and password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    # Absolute paths in a command (words starting with /, quoted or not) moved under root, as SFTP paths are,
+    # so exec never touches the real filesystem. /dev stays as it is for redirections.
+    def rootedCommand(self, command):
+        lexer = shlex.shlex(command, posix=False, punctuation_chars=True)
+        lexer.whitespace_split = True
+        rooted, pos = [], 0
+        for word in lexer:
+            start = command.index(word, pos)
+            path = word.lstrip('\'"')
+            rooted.append(command[pos:start])
+            if path.startswith('/') and not path.startswith('/dev/'):
+                rooted.append(shlex.quote(self.root.rstrip('/')))
+            rooted.append(word)
+            pos = start + len(word)
+        return ''.join(rooted) + command[pos:]
+
+    # Run the command in a shell under root, feeding channel input to stdin (for tar streams and scp -t)
+    def check_channel_exec_request(self, channel, command):
+        def execWorker():
+            proc = subprocess.Popen(self.rootedCommand(command.decode()), shell=True, cwd=self.root,
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+            # Input for a command that already exited is dropped, as sshd does
+            def feedStdin():
+                try:
+                    for data in iter(lambda: channel.recv(65536), b''):
+                        proc.stdin.write(data)
+                        proc.stdin.flush()
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+            def drainStderr():
+                for data in iter(lambda: proc.stderr.read(65536), b''):
+                    channel.sendall_stderr(data)
+
+            threading.Thread(target=feedStdin, daemon=True).start()
+            errpump = threading.Thread(target=drainStderr, daemon=True)
+            errpump.start()
+            for data in iter(lambda: proc.stdout.read1(65536), b''):
+                channel.sendall(data)
+            errpump.join()
+            proc.wait()
+            # Clients that close the channel as soon as they're done (asyncssh's scp) mustn't get anything after
+            # their close; close() sends our EOF and close together
+            if not channel.closed:
+                channel.send_exit_status(proc.returncode)
+            channel.close()
+
+        threading.Thread(target=execWorker, daemon=True).start()
+        return True
+
+
+class benchSFTPHandle(SFTPHandle):
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+# SFTP subsystem mapping remote absolute paths onto the server root
+class benchSFTPServer(SFTPServerInterface):
+
+    def __init__(self, server, *args, **kwargs):
+        self.root = server.root
+        super().__init__(server, *args, **kwargs)
+
+    def localPath(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path).replace('\\', '/').replace('//', '/')
+
+    def list_folder(self, path):
+        try:
+            local = self.localPath(path)
+            return [SFTPAttributes.from_stat(os.lstat(os.path.join(local, name)), name) for name in os.listdir(local)]
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.localPath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.localPath(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = benchSFTPHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self.osCall(os.remove, path)
+
+    def rmdir(self, path):
+        return self.osCall(os.rmdir, path)
+
+    def mkdir(self, path, attr):
+        return self.osCall(os.mkdir, path)
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.localPath(oldpath), self.localPath(newpath))
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_size is not None:
+                os.truncate(self.localPath(path), attr.st_size)
+            if attr.st_mtime is not None:
+                os.utime(self.localPath(path), (attr.st_atime, attr.st_mtime))
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def osCall(self, func, path):
+        try:
+            func(self.localPath(path))
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+def serveClient(client, root, username, password):
+    transport = paramiko.Transport(client)
+    transport.add_server_key(host_key)
+    transport.set_subsystem_handler('sftp', SFTPServer, benchSFTPServer)
+    server = benchSSHServer(root, username, password)
+    transport.start_server(server=server)
+
+# Start a server in a background thread. Returns the (host, port) it listens on; port 0 picks a free one.
+def startServer(root, port=0, username='mpfu', password='mpfu'):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(128)
+
+    def acceptLoop():
+        while True:
+            client, _ = sock.accept()
+            threading.Thread(target=serveClient, args=(client, root, username, password), daemon=True).start()
+
+    threading.Thread(target=acceptLoop, daemon=True).start()
+    return sock.getsockname()
+
+
+if __name__ == '__main__':
+    root = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 2222
+    host, port = startServer(root, port)
+    print(f"Serving {root} over SSH/SFTP on {host}:{port} (user mpfu, password mpfu). Ctrl-C to stop.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
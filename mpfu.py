@@ -4,12 +4,18 @@ import os
 import sys
 import platform
 import socket
+import errno
 import getpass
 import glob
 import paramiko
 import warnings
 import urllib
 import argparse
+import shutil
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Detect platform
 plat_type = platform.system()
@@ -26,16 +32,253 @@ if plat_type == 'Windows':
 # Homepath of script
 homepath = os.path.abspath(os.path.dirname(__file__))
 
-# CLI arguments
-parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument('-l','--list', required=False, help="""
+# Size argument with optional K/M/G suffix, i.e. 64M
+def parseSize(sizevar):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    sizevar = str(sizevar).strip().upper().rstrip('B')
+    try:
+        if sizevar[-1:] in units:
+            return int(float(sizevar[:-1]) * units[sizevar[-1]])
+        return int(sizevar)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size '{sizevar}'")
+
+# Batch of hosts as a number or a percentage of the serverlist, i.e. 20 or 10%. Returns (number, is percentage).
+def parseBatch(batchvar):
+    batchvar = str(batchvar).strip()
+    try:
+        batch = (float(batchvar[:-1]), True) if batchvar.endswith('%') else (int(batchvar), False)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid batch size '{batchvar}'")
+    if batch[0] <= 0:
+        raise argparse.ArgumentTypeError(f"batch size must be positive, not '{batchvar}'")
+    return batch
+
+# CLI arguments. Options shared by the menu and the headless subcommands are added by addSharedArgs()
+# so they can be given either before or after the subcommand name.
+def addSharedArgs(p, suppress=False):
+    default = lambda d: argparse.SUPPRESS if suppress else d
+    p.add_argument('-l','--list', required=False, default=default(None), help="""
 A list of servers to upload files and/or issue SSH commands to may be provided when running MPFU.
 Provide the serverlist as a text file, with one server per line in the following format:
 
 protocol:Destination IP or hostname:/remote/upload/path/:username:password 
 
+A [name] line puts the servers below it in group name. Serverlists ending in .yaml/.yml, .toml or
+.csv are read as structured inventories instead: hosts with protocol, host, path (or bucket),
+user, password, groups and tags fields, plus optional defaults and groups sections (YAML and TOML).
+The serverlist is read once per MPFU session.
+
+""")
+    p.add_argument('-t','--target', required=False, action='append', default=default(None), help="""
+Only use the serverlist hosts in these groups, tags or host names. Comma separated names must all
+match (web,eu-west is the web hosts tagged eu-west); give --target again to add another selection.
+
+""")
+    p.add_argument('-p','--parallel', required=False, type=int, default=default(1), help="""
+Number of destinations from a serverlist to upload to at the same time (default 1, one after another).
+All destinations running at once share a single progress line with their total bytes, rate and
+ETA, and a result table is printed when all destinations have finished.
+
+""")
+    p.add_argument('--canary', required=False, type=parseBatch, default=default(None), help="""
+Roll out to this many serverlist destinations first, as a number or a percentage (i.e. 1 or 5%%),
+and only continue to the rest if the failure rate stays within --max-fail.
+
+""")
+    p.add_argument('--wave', required=False, type=parseBatch, default=default(None), help="""
+Roll out in waves of this many destinations, as a number or a percentage of the serverlist
+(i.e. 50 or 10%%), after the --canary batch if one is given. Each wave runs all its destinations
+at once, or --parallel at a time if that is set. Applies to serverlist uploads and commands.
+
+""")
+    p.add_argument('--max-fail', required=False, type=float, default=default(0), help="""
+With --canary or --wave, stop the rollout after a wave once more than this percentage of the
+destinations run so far have failed (default 0, stop on the first failure). Destinations not
+reached are reported as skipped.
+
+""")
+    p.add_argument('--wave-pause', required=False, type=float, default=default(0), help="""
+Seconds to wait between waves (default 0). Ctrl-C while waiting stops the rollout.
+
+""")
+    p.add_argument('--retries', required=False, type=int, default=default(2), help="""
+Retry a serverlist destination this many times after a transient failure (timeouts, refused or
+dropped connections, FTP 4xx replies) before counting it as failed (default 2). Authentication and
+other permanent errors aren't retried. S3 requests are retried as often by boto3 itself.
+Combine with --skip-sent or --resume so a retry carries on where the failed attempt stopped.
+
+""")
+    p.add_argument('--retry-delay', required=False, type=float, default=default(1), help="""
+Base delay before a retry in seconds, doubled on every further retry up to 30 seconds, with
+random jitter so hosts that failed together don't retry together (default 1).
+
+""")
+    p.add_argument('--breaker', required=False, type=int, default=default(3), help="""
+Transient failures in a row (timeouts, refused or dropped connections) after which a host is given
+up on: its remaining destinations fail at once instead of waiting for more timeouts, until
+--breaker-reset seconds have passed (default 3, 0 turns it off). Login errors don't count.
+
+""")
+    p.add_argument('--breaker-reset', required=False, type=float, default=default(60), help="""
+Seconds before a host given up on by --breaker is tried again (default 60).
+
+""")
+    p.add_argument('--connect-timeout', required=False, type=float, default=default(8), help="""
+Seconds to wait for an FTP, SFTP/SCP or SMB server to accept the connection and log in (default 8).
+FTP also uses it for every later control and data connection read, so a stalled FTP transfer fails
+and can be retried instead of hanging.
+
+""")
+    p.add_argument('--no-preflight', required=False, action='store_true', default=default(False), help="""
+Skip the pre-flight phase of serverlist runs. Normally every hostname in the list is resolved at once
+and the FTP, SFTP, SCP and SMB connections are opened and logged in to in parallel before transfers
+start, so unreachable hosts are reported (and left out of the run) within seconds.
+
+""")
+    p.add_argument('--sync', required=False, action='store_true', default=default(False), help="""
+Directory upload only sends files that are new or whose size or modification time differ from the
+remote copy. Each remote directory is listed once instead of checking files one by one.
+
+""")
+    p.add_argument('--delete', required=False, action='store_true', default=default(False), help="""
+With directory upload, delete remote files and directories that no longer exist locally (implies --sync).
+
+""")
+    p.add_argument('--skip-sent', required=False, action='store_true', default=default(False), help="""
+Record every successful file upload in a local manifest (manifest.mpfu next to MPFU) and skip files
+that the manifest shows were already delivered unchanged to the same destination and remote path.
+No remote round trip is needed to decide, which helps most with FTP and SMB.
+
+""")
+    p.add_argument('--resume', required=False, action='store_true', default=default(False), help="""
+Resume interrupted SFTP and FTP uploads. If a shorter copy of the file is already on the server and
+its first and last bytes match the local file, only the rest of the file is sent. A copy of the same
+size is read back in full and only skipped if it's identical.
+
+""")
+    p.add_argument('--streams', required=False, type=int, default=default(1), help="""
+Send large SFTP files as N byte ranges written in parallel over N SSH sessions to the same host
+(default 1, off). Only files of at least --stream-threshold bytes are split.
+
+""")
+    p.add_argument('--stream-threshold', required=False, type=parseSize, default=default(parseSize('64M')), help="""
+Smallest file size sent with --streams, in bytes or with a K, M or G suffix (default 64M).
+
+""")
+    p.add_argument('--fast', required=False, action='store_true', default=default(False), help="""
+Use the fast SSH transport profile for every SFTP host: larger channel window and packet size, AES-GCM
+ciphers preferred when the server offers them, and larger pipelined SFTP writes without a confirming
+stat. Individual serverlist entries can opt in with the protocol sftp+fast instead.
+
+""")
+    p.add_argument('--tar', required=False, action='store_true', default=default(False), help="""
+Directory upload streams the whole tree as one tar archive over a single SSH exec channel into
+'tar x' on the remote side, instead of one SFTP round trip per directory and file. Much faster for
+trees of many small files. Needs tar on the remote host; --sync and --delete don't apply.
+
+""")
+    p.add_argument('--compress', required=False, choices=['gz', 'bz2', 'xz'], default=default(None), help="""
+Compress the --tar stream with gzip, bzip2 or xz (default none). Helps on slow links with
+compressible files.
+
+""")
+    p.add_argument('--s3-threads', required=False, type=int, default=default(10), help="""
+Worker threads for S3 uploads (default 10). Files and multipart parts of large files all share
+this pool, so many files upload at once.
+
 """)
-args = parser.parse_args()
+    p.add_argument('--s3-chunk', required=False, type=parseSize, default=default(parseSize('8M')), help="""
+S3 multipart chunk size, also the size above which files are sent in parts (default 8M).
+
+""")
+    p.add_argument('--s3-endpoint', required=False, default=default(None), help="""
+S3 endpoint URL for S3-compatible storage (MinIO, a local mock, etc.) instead of AWS.
+
+""")
+    p.add_argument('--s3-skip', required=False, action='store_true', default=default(False), help="""
+Skip S3 uploads of files already in the bucket unchanged. The bucket is listed once per upload
+and objects are compared by size and by ETag (MD5, or the multipart ETag for files uploaded in
+--s3-chunk parts), with no request per file.
+
+""")
+    p.add_argument('--ftp-block', required=False, type=parseSize, default=default(parseSize('1M')), help="""
+FTP block size: bytes handed to the data connection per write and per progress update (default 1M).
+
+""")
+    p.add_argument('--ftp-sessions', required=False, type=int, default=default(1), help="""
+Number of FTP sessions (control and data connection pairs) opened to each server so several files
+transfer at once (default 1). Sessions stay open and are reused for the rest of the MPFU session.
+
+""")
+    p.add_argument('--smb-sessions', required=False, type=int, default=default(4), help="""
+Number of SMB connections opened to each server so several files are stored on the share at once
+(default 4). Connections stay open and are reused for the rest of the MPFU session.
+
+""")
+    p.add_argument('--smb-min-rate', required=False, type=parseSize, default=default(parseSize('1M')), help="""
+Slowest transfer rate, in bytes per second, an SMB upload is allowed before it times out (default 1M).
+Each file gets 60 seconds plus its size divided by this rate.
+
+""")
+    p.add_argument('--metrics-log', required=False, default=default(None), help="""
+Append one JSON line per transferred file to this file: host, protocol, file, bytes, DNS, connect,
+auth, first-byte and transfer times, and throughput.
+
+""")
+    p.add_argument('--prom-file', required=False, default=default(None), help="""
+Write per-host transfer metrics of each run to this file in Prometheus text format, for the
+node_exporter textfile collector (i.e. /var/lib/node_exporter/textfile/mpfu.prom).
+
+""")
+    p.add_argument('--backend', required=False, choices=['paramiko', 'asyncio'], default=default('paramiko'), help="""
+SSH backend for the SFTP and SCP destinations and commands of a serverlist run (default paramiko).
+asyncio (needs asyncssh) runs every session on one event loop instead of a thread per host, so
+--parallel can go into the hundreds or thousands. FTP, SMB and S3 destinations of the same run
+and the options only the paramiko code has (--fast, --resume, --streams, --tar, --sync, --delete)
+keep to the paramiko backend.
+
+""")
+    p.add_argument('-d','--dest', required=False, action='append', default=default(None), help="""
+Destination in serverlist format, may be given more than once. Used by the headless subcommands
+in addition to (or instead of) --list:
+
+mpfu upload --dest sftp:web01:/srv/app/:deploy:secret --files 'dist/*.tar.gz'
+
+""")
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, epilog="""
+Run without a subcommand for the interactive menu. The subcommands below run headless: no menu,
+no prompts and no progress bars, and exit with 0 if every destination succeeded, 1 if any failed
+and 2 on bad arguments.
+""")
+addSharedArgs(parser)
+subparsers = parser.add_subparsers(dest='command', metavar='{upload,dir,exec}')
+
+upload_p = subparsers.add_parser('upload', formatter_class=argparse.RawTextHelpFormatter,
+                                 help="Upload files to every destination in the serverlist")
+addSharedArgs(upload_p, suppress=True)
+upload_p.add_argument('-f','--files', required=True, action='append', help="""
+Local file or wildcard pattern to upload (quote wildcards), may be given more than once.
+
+""")
+
+dir_p = subparsers.add_parser('dir', formatter_class=argparse.RawTextHelpFormatter,
+                              help="Upload a local directory recursively to every SFTP, SCP and SMB destination")
+addSharedArgs(dir_p, suppress=True)
+dir_p.add_argument('--local', required=True, help="Local directory to upload.")
+dir_p.add_argument('--remote', required=True, help="Remote directory to upload into (created if nonexistent).")
+
+exec_p = subparsers.add_parser('exec', formatter_class=argparse.RawTextHelpFormatter,
+                               help="Run a command over SSH on every destination in the serverlist")
+addSharedArgs(exec_p, suppress=True)
+exec_p.add_argument('cmd', nargs='+', help="Command to run (use -- before commands that start with a dash).")
+
+# Defaults for when mpfu is imported; replaced with the real command line under __main__
+args = parser.parse_args([])
+
+# Set when running a headless subcommand: no prompts, no progress output
+headless = False
 
 # Color tags
 if plat_type == 'Linux':
@@ -52,6 +295,310 @@ _nc = '\033[0m'
 # Filter paramiko warnings until new version with bugfix released
 warnings.filterwarnings(action='ignore', module='.*paramiko.*')
 
+# Per-thread state. Worker threads of a parallel run set quiet so progress bars and prompts stay out of the way
+threadstate = threading.local()
+
+def isQuiet():
+    return headless or getattr(threadstate, 'quiet', False)
+
+# Pause after an error so it can be read, unless running headless, as a parallel worker or as a serverlist
+# destination (noprompt, set by mpfuFanout, whose result table reports the error)
+def keyPrompt(msg="Press a key to continue..."):
+    if isQuiet() or getattr(threadstate, 'noprompt', False):
+        return
+    input(msg)
+    print(" ")
+
+# An upload function caught e and is about to return False. Keep e for the retry layer (see retryCall) to classify,
+# then pause like keyPrompt.
+def transferFailed(e):
+    threadstate.failure = e
+    keyPrompt()
+
+# Hide or show the terminal cursor while a line is redrawn in place
+def showCursor(show):
+    if headless:
+        return
+    sys.stdout.write('\033[?25h' if show else '\033[?25l')
+    sys.stdout.flush()
+
+# Human readable duration for ETAs, i.e. 1:05:09 or 4:32
+def hms(secs):
+    m, s = divmod(int(secs), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02}:{s:02}" if h else f"{m}:{s:02}"
+
+# Progress display shared by every transfer in the session. Transfers register their size with begin(), report bytes
+# with update() from any thread and call end() when done, so callbacks cost one addition. While anything is running,
+# one thread redraws a single line at a fixed rate with the aggregate size, rate and ETA of all running transfers.
+# Nothing is drawn, and no thread started, when headless.
+class transferProgress(object):
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.total = 0
+        self.sent = 0
+        self.running = 0
+        self.started = 0
+        self.stop = None
+        self.renderer = None
+
+    def begin(self, nbytes):
+        if headless:
+            return
+        with self.lock:
+            self.total += nbytes
+            self.running += 1
+            if self.renderer is None:
+                self.started = time.monotonic()
+                self.stop = threading.Event()
+                self.renderer = threading.Thread(target=self.render, args=(self.stop,), daemon=True)
+                self.renderer.start()
+
+    def update(self, nbytes):
+        if headless:
+            return
+        with self.lock:
+            self.sent += nbytes
+
+    # Callback for libraries that report the bytes sent so far of one file, as (sent, total)
+    def cumulative(self):
+        last = 0
+
+        def callback(sent, total):
+            nonlocal last
+            self.update(sent - last)
+            last = sent
+        return callback
+
+    # A transfer finished. The last one out draws the final line and resets the counters.
+    def end(self):
+        if headless:
+            return
+        with self.lock:
+            self.running -= 1
+            if self.running > 0:
+                return
+            self.stop.set()
+            self.renderer.join()
+            self.total = self.sent = 0
+            self.renderer = None
+
+    def render(self, stop):
+        showCursor(False)
+        samples = [(self.started, 0)]
+        while not stop.wait(self.interval):
+            samples.append((time.monotonic(), self.sent))
+            # Rate over the last few seconds, so it follows changes in link speed
+            while len(samples) > 2 and samples[-1][0] - samples[0][0] > 3:
+                samples.pop(0)
+            self.draw(samples)
+        samples.append((time.monotonic(), self.sent))
+        self.draw([(self.started, 0), samples[-1]])
+        sys.stdout.write("\n")
+        showCursor(True)
+
+    def draw(self, samples):
+        (t0, s0), (t1, s1) = samples[0], samples[-1]
+        total = max(self.total, s1, 1)
+        rate = (s1 - s0) / (t1 - t0) if t1 > t0 else 0
+        percent = float(s1) / total
+        hashes = '#' * int(percent * 30)
+        line = f"[{hashes.ljust(30)}] {percent * 100:5.1f}%  {s1 / 1048576:.1f}/{total / 1048576:.1f} MB  {rate / 1048576:.1f} MB/s"
+        if s1 < total:
+            line += f"  ETA {hms((total - s1) / rate) if rate else '--:--'}"
+        else:
+            line += f"  in {hms(t1 - self.started)}"
+        if self.running > 1:
+            line += f"  ({self.running} transfers)"
+        sys.stdout.write("\r" + line + "\033[K")
+        sys.stdout.flush()
+
+progress = transferProgress()
+
+# Timing of one file transfer, from transferMetrics.start(). first() marks the first bytes going out (wrap() does
+# it from a progress callback) and done() records the finished transfer.
+class transferTimer(object):
+
+    def __init__(self, metrics, protvar, servvar, name):
+        self.metrics = metrics
+        self.protvar = protvar
+        self.servvar = servvar
+        self.name = name
+        self.started = time.monotonic()
+        self.firstbyte = None
+
+    def first(self):
+        if self.firstbyte is None:
+            self.firstbyte = time.monotonic()
+
+    def wrap(self, callback):
+        def timed(*cbargs):
+            if self.firstbyte is None:
+                self.firstbyte = time.monotonic()
+            return callback(*cbargs)
+        return timed
+
+    def done(self, nbytes):
+        self.metrics.record(self, nbytes, time.monotonic())
+
+# Per-transfer metrics of the current run. Pools report the DNS, connect and auth time of every connection they open
+# with connected(); the next transfer to that host over that pool carries them (later transfers reuse the connection
+# and have none). SFTP and SCP share the SSH pool.
+# report() prints the slowest hosts, writes --metrics-log and --prom-file and starts a new run.
+class transferMetrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.setups = {}
+        self.spans = {}
+
+    def connected(self, poolname, servvar, dns, connect, auth):
+        with self.lock:
+            self.setups.setdefault((poolname, servvar), []).append((dns, connect, auth))
+
+    def start(self, protvar, servvar, name):
+        return transferTimer(self, protvar, servvar, name)
+
+    def record(self, timer, nbytes, finished):
+        with self.lock:
+            poolname = "ssh" if timer.protvar in ("sftp", "scp") else timer.protvar
+            setups = self.setups.get((poolname, timer.servvar))
+            dns, connect, auth = setups.pop(0) if setups else (None, None, None)
+            secs = finished - timer.started
+            # Earliest start and latest finish per (host, protocol): files sent at once overlap, so their
+            # transfer_s don't add up to the time the host took
+            span = self.spans.setdefault((timer.servvar, timer.protvar), [timer.started, finished])
+            span[0], span[1] = min(span[0], timer.started), max(span[1], finished)
+            self.records.append({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'host': timer.servvar,
+                'protocol': timer.protvar,
+                'file': timer.name,
+                'bytes': nbytes,
+                'dns_s': dns,
+                'connect_s': connect,
+                'auth_s': auth,
+                'first_byte_s': timer.firstbyte - timer.started if timer.firstbyte else None,
+                'transfer_s': secs,
+                'throughput_bps': nbytes / secs if secs > 0 else None,
+            })
+
+    # Records of the run summed per (host, protocol), with throughput over the wall-clock span of the host's
+    # transfers from spans
+    def hosts(self, records, spans):
+        hosts = {}
+        for rec in records:
+            h = hosts.setdefault((rec['host'], rec['protocol']),
+                                 {'files': 0, 'bytes': 0, 'span_s': 0.0, 'dns_s': 0.0, 'connect_s': 0.0,
+                                  'auth_s': 0.0, 'first_byte_s': 0.0, 'first_bytes': 0})
+            h['files'] += 1
+            h['bytes'] += rec['bytes']
+            for phase in ('dns_s', 'connect_s', 'auth_s'):
+                h[phase] += rec[phase] or 0
+            if rec['first_byte_s'] is not None:
+                h['first_byte_s'] += rec['first_byte_s']
+                h['first_bytes'] += 1
+        for key, h in hosts.items():
+            h['span_s'] = spans[key][1] - spans[key][0]
+            h['throughput_bps'] = h['bytes'] / h['span_s'] if h['span_s'] > 0 else 0
+        return hosts
+
+    def report(self):
+        with self.lock:
+            records, self.records = self.records, []
+            spans, self.spans = self.spans, {}
+            self.setups.clear()
+        if not records:
+            return
+        hosts = self.hosts(records, spans)
+        if args.metrics_log:
+            import json
+            with open(args.metrics_log, 'a') as log:
+                for rec in records:
+                    log.write(json.dumps(rec) + "\n")
+        if args.prom_file:
+            self.writeProm(hosts)
+
+        # Slowest hosts by throughput, when there is more than one to compare
+        if len(hosts) > 1:
+            slowest = sorted(hosts.items(), key=lambda h: h[1]['throughput_bps'])[:3]
+            print(f"{bld_}Slowest hosts{_nc}")
+            for (servvar, protvar), h in slowest:
+                setup = h['dns_s'] + h['connect_s'] + h['auth_s']
+                firstbyte = f"{h['first_byte_s'] / h['first_bytes']:.2f}s" if h['first_bytes'] else "n/a"
+                print(f"  {b_}{servvar}{_nc} ({protvar.upper()}): {y_}{h['throughput_bps'] / 1048576:.1f} MB/s{_nc} over "
+                      f"{h['files']} files, {setup:.2f}s connection setup, {firstbyte} to first byte")
+            print("")
+
+    # Prometheus text format, written to a temp file and renamed so the collector never reads a partial file
+    def writeProm(self, hosts):
+        metrics = (
+            ('mpfu_transfer_bytes', 'Bytes uploaded in the last run', lambda h: h['bytes']),
+            ('mpfu_transfer_files', 'Files uploaded in the last run', lambda h: h['files']),
+            ('mpfu_transfer_seconds', 'Time from the first file starting to the last finishing in the last run', lambda h: h['span_s']),
+            ('mpfu_throughput_bytes_per_second', 'Upload throughput in the last run', lambda h: h['throughput_bps']),
+            ('mpfu_dns_seconds', 'DNS lookup time of connections opened in the last run', lambda h: h['dns_s']),
+            ('mpfu_connect_seconds', 'TCP connect time of connections opened in the last run', lambda h: h['connect_s']),
+            ('mpfu_auth_seconds', 'Handshake and authentication time of connections opened in the last run', lambda h: h['auth_s']),
+        )
+        lines = []
+        for name, helptext, value in metrics:
+            lines.append(f"# HELP {name} {helptext}")
+            lines.append(f"# TYPE {name} gauge")
+            for (servvar, protvar), h in sorted(hosts.items()):
+                host = servvar.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'{name}{{host="{host}",protocol="{protvar}"}} {value(h)}')
+        lines.append("# HELP mpfu_last_run_timestamp_seconds Time the last run finished")
+        lines.append("# TYPE mpfu_last_run_timestamp_seconds gauge")
+        lines.append(f"mpfu_last_run_timestamp_seconds {time.time()}")
+        with open(args.prom_file + '.tmp', 'w') as prom:
+            prom.write("\n".join(lines) + "\n")
+        os.replace(args.prom_file + '.tmp', args.prom_file)
+
+metrics = transferMetrics()
+
+# Resolved addresses per (hostname, address family) for the whole MPFU session, as (time resolved, getaddrinfo list).
+# Entries older than dns_ttl seconds are looked up again; failed lookups aren't cached.
+dns_cache = {}
+dns_lock = threading.Lock()
+dns_ttl = 300
+
+# socket.getaddrinfo for a TCP connection to servvar:port, answered from dns_cache when possible
+def resolveHost(servvar, port, family=0):
+    key = (servvar, family)
+    with dns_lock:
+        cached = dns_cache.get(key)
+    if cached is None or time.monotonic() - cached[0] > dns_ttl:
+        cached = (time.monotonic(), socket.getaddrinfo(servvar, None, family, socket.SOCK_STREAM))
+        with dns_lock:
+            dns_cache[key] = cached
+    return [(f, t, proto, name, (addr[0], port) + addr[2:]) for f, t, proto, name, addr in cached[1]]
+
+# Resolve and connect a TCP socket, reporting how long each step took. Returns (socket, dns seconds, connect seconds).
+# Every address is tried in turn like socket.create_connection does, so a broken IPv6 route falls back to IPv4;
+# the connect time is that of the attempt that succeeded.
+def timedConnect(servvar, port, timeout):
+    start = time.monotonic()
+    addrs = resolveHost(servvar, port)
+    resolved = time.monotonic()
+    for family, socktype, proto, _, sockaddr in addrs:
+        attempt = time.monotonic()
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(sockaddr)
+            return sock, resolved - start, time.monotonic() - attempt
+        except OSError as e:
+            sock.close()
+            error = e
+        except BaseException:
+            sock.close()
+            raise
+    raise error
+
 # Tab completion code from https://gist.github.com/iamatypeofwalrus/5637895
 class tabCompleter(object):
 
@@ -238,25 +785,447 @@ def localfsPrompt():
     fs = dirvar, filevar, fileglob
     return fs
 
-# Modified progress provider for SCP. fname parameter added but left blank to align with scp module callback output
-# Annoyingly must be in global namespace because it's called by connection, not transfer
+# Progress callback for SCP, which reports (filename, size, bytes sent so far) for each file in turn.
+# Must be in global namespace because it's set on the connection, not the transfer. Files are timed for the
+# metrics when the uploading thread has set threadstate.scp_host to (protocol, host).
 def sbar(fname, total_bytes, transfered_bytes):
-    bar_length = 35
-    percent = float(transfered_bytes) / total_bytes
-    hashes = '#' * int(round(percent * bar_length))
-    spaces = ' ' * (bar_length - len(hashes))
-    message = "\rSize: " + str(total_bytes) + " bytes("\
-        + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-    message += " || Amount of file transferred: [{}] {}%\r".format(hashes + spaces,
-                                                                    round(percent * 100, 2))
-    if transfered_bytes == total_bytes:
-        message = "\rSize: " + str(total_bytes) + " bytes("\
-            + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-        message += " || File transferred. [{}] {}%                    \r"\
-            .format(hashes + spaces, round(percent * 100, 2))
-    sys.stdout.write(message)
-    sys.stdout.flush()
+    last = getattr(threadstate, 'scp_sent', 0)
+    if transfered_bytes < last:
+        last = 0
+    progress.update(transfered_bytes - last)
+    threadstate.scp_sent = 0 if transfered_bytes >= total_bytes else transfered_bytes
+
+    scp_host = getattr(threadstate, 'scp_host', None)
+    if scp_host:
+        if last == 0 and transfered_bytes < total_bytes:
+            threadstate.scp_timer = metrics.start(scp_host[0], scp_host[1], fname.decode(errors='replace'))
+        timer = getattr(threadstate, 'scp_timer', None)
+        if timer and transfered_bytes > 0:
+            timer.first()
+        if timer and transfered_bytes >= total_bytes:
+            timer.done(total_bytes)
+            threadstate.scp_timer = None
+
+
+# Fast SSH transport profile (--fast, or sftp+fast in the serverlist). AES-GCM is an AEAD cipher, so it skips the
+# separate MAC pass the CTR/CBC ciphers need; a bigger window and packet size keep more data in flight per round trip.
+fast_ciphers = ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com', 'aes128-ctr', 'aes256-ctr')
+fast_window_size = 16 * 1024 * 1024
+fast_packet_size = 256 * 1024
+fast_request_size = 128 * 1024
+
+# Hosts whose serverlist entry asked for the fast profile. Emptied each time a serverlist is loaded, so a host
+# marked fast by one list isn't fast for the lists that follow.
+fast_hosts = set()
+
+def isFast(servvar):
+    return args.fast or servvar in fast_hosts
+
+# paramiko transport_factory building a Transport with the fast profile applied
+def fastTransport(sock, **kwargs):
+    kwargs.update(default_window_size=fast_window_size, default_max_packet_size=fast_packet_size)
+    transport = paramiko.Transport(sock, **kwargs)
+    opts = transport.get_security_options()
+    offered = list(opts.ciphers)
+    opts.ciphers = [c for c in fast_ciphers if c in offered] + [c for c in offered if c not in fast_ciphers]
+    return transport
+
+# SFTP put. With the fast profile the file is written in bigger pipelined requests and the confirming stat is skipped.
+def sftpPut(sftpc, servvar, g, rempath, callback=None):
+    if not isFast(servvar):
+        return sftpc.put(g, rempath, callback=callback)
+
+    size = os.path.getsize(g)
+    sent = 0
+    with open(g, 'rb') as file, sftpc.open(rempath, 'wb') as remfile:
+        remfile.MAX_REQUEST_SIZE = fast_request_size
+        remfile.set_pipelined(True)
+        for block in iter(lambda: file.read(fast_request_size), b''):
+            remfile.write(block)
+            sent += len(block)
+            if callback:
+                callback(sent, size)
+
+# Digest of a password for pool keys, so plain passwords aren't spread through them
+def passDigest(passvar):
+    import hashlib
+
+    return hashlib.sha256(passvar.encode()).hexdigest() if passvar else None
+
+# Pool of authenticated SSH connections keyed by (host, port, user, password digest), kept alive for the whole MPFU session.
+# SFTP, SCP and command channels are all opened on the pooled transport, so each host pays for TCP,
+# key exchange and authentication once no matter how many uploads and commands follow.
+class sshPool(object):
+
+    # port is used for connections that don't name one (serverlist entries have no port field)
+    def __init__(self, port=22):
+        self.port = port
+        self.clients = {}
+        self.creds = {}
+        self.lock = threading.Lock()
+        self.keylocks = {}
+
+    # slot > 0 gives additional connections to the same host, for transfers that want several
+    # independent sessions at once (see sftpMultiStream)
+    def connect(self, servvar, uservar, passvar=None, port=None, slot=0):
+        port = port or self.port
+        credkey = (servvar, port, uservar)
+        # No password means the one that last logged in to this host and user (or keys only)
+        passvar = passvar or self.creds.get(credkey)
+        # Connections are only shared between callers with the same password, so a serverlist entry with a
+        # wrong one fails instead of riding on another entry's login
+        key = credkey + (passDigest(passvar), slot)
+        with self.lock:
+            keylock = self.keylocks.setdefault(key, threading.Lock())
+
+        # One connect per host at a time; other threads wanting the same host wait and reuse it
+        with keylock:
+            pssh = self.clients.get(key)
+            if pssh is not None:
+                transport = pssh.get_transport()
+                if transport is not None and transport.is_active():
+                    return pssh
+                pssh.close()
+
+            pssh = paramiko.SSHClient()
+            pssh.load_system_host_keys()
+            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
+            factory = fastTransport if isFast(servvar) else None
+            sock, dns, connect = timedConnect(servvar, port, args.connect_timeout)
+            authstart = time.monotonic()
+            try:
+                # SSH keys and agent are tried first, then the password if one is known
+                pssh.connect(hostname=servvar, port=port, username=uservar, sock=sock,
+                             password=passvar or None, timeout=args.connect_timeout, transport_factory=factory)
+            except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
+                if passvar or isQuiet():
+                    raise
+                print(
+                    f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
+                passvar = getpass.getpass('')
+                sock, dns, connect = timedConnect(servvar, port, args.connect_timeout)
+                authstart = time.monotonic()
+                pssh.connect(hostname=servvar, port=port, username=uservar, sock=sock,
+                             password=passvar, timeout=args.connect_timeout, transport_factory=factory)
+                key = credkey + (passDigest(passvar), slot)
+            metrics.connected("ssh", servvar, dns, connect, time.monotonic() - authstart)
+
+            self.creds[credkey] = passvar
+            self.clients[key] = pssh
+            return pssh
+
+    def sftp(self, servvar, uservar, passvar=None, port=None, slot=0):
+        return self.connect(servvar, uservar, passvar, port, slot).open_sftp()
+
+    def scp(self, servvar, uservar, passvar=None, port=None, progress=None):
+        import scp
+        return scp.SCPClient(self.connect(servvar, uservar, passvar, port).get_transport(),
+                             progress=progress or sbar)
+
+    # Run a command on an exec channel of the pooled connection. Output is echoed as it arrives if echo is set.
+    # Returns (exit code, stdout, stderr).
+    def run(self, servvar, uservar, passvar, cmdvar, port=None, echo=True):
+        import codecs
+
+        chan = self.connect(servvar, uservar, passvar, port).get_transport().open_session()
+        chan.exec_command(cmdvar)
+        outdec = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        errdec = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        stdout, stderr = [], []
+
+        # stdout and stderr share the channel window, so both are drained as data arrives
+        while True:
+            if chan.recv_ready():
+                data = outdec.decode(chan.recv(32768))
+                stdout.append(data)
+                if echo:
+                    sys.stdout.write(data)
+                    sys.stdout.flush()
+            elif chan.recv_stderr_ready():
+                data = errdec.decode(chan.recv_stderr(32768))
+                stderr.append(data)
+                if echo:
+                    sys.stderr.write(data)
+                    sys.stderr.flush()
+            elif chan.eof_received and chan.exit_status_ready():
+                break
+            else:
+                time.sleep(0.01)
+        rc = chan.recv_exit_status()
+        chan.close()
+        return rc, "".join(stdout) + outdec.decode(b'', final=True), "".join(stderr) + errdec.decode(b'', final=True)
+
+    def closeAll(self):
+        with self.lock:
+            for pssh in self.clients.values():
+                pssh.close()
+            self.clients.clear()
+
+sshpool = sshPool()
+
+# Pool of logged-in FTP sessions per (host, user), kept open for the whole MPFU session. FTP control connections
+# aren't thread safe, so a session is taken out with get() by one worker at a time and handed back with put().
+# Several workers asking for the same server at once get separate sessions.
+class ftpPool(object):
+
+    def __init__(self, port=21):
+        self.port = port
+        self.idle = {}
+        self.homes = {}
+        self.lock = threading.Lock()
+
+    def get(self, servvar, uservar, passvar):
+        import ftplib
+
+        key = (servvar, uservar)
+        while True:
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                session = idle.pop() if idle else None
+            if session is None:
+                break
+            # Back to the login directory, which also checks the server hasn't dropped the session
+            try:
+                session.cwd(self.homes[session])
+                return session
+            except ftplib.all_errors:
+                self.discard(session)
+
+        # The timeout also covers every later control and data connection read, so a stalled transfer fails
+        # (and can be retried) instead of hanging
+        session = ftplib.FTP_TLS(timeout=args.connect_timeout)
+        start = time.monotonic()
+        addrs = resolveHost(servvar, self.port)
+        resolved = time.monotonic()
+        # Every address in turn, as in timedConnect
+        for n, addrinfo in enumerate(addrs):
+            attempt = time.monotonic()
+            try:
+                session.connect(addrinfo[4][0], self.port)
+                break
+            except OSError:
+                if n == len(addrs) - 1:
+                    raise
+        connected = time.monotonic()
+        session.sendcmd(f'USER {uservar}')
+        session.sendcmd(f'PASS {passvar}')
+        metrics.connected("ftp", servvar, resolved - start, connected - attempt, time.monotonic() - connected)
+        home = ftplib.parse257(session.sendcmd('pwd'))
+        with self.lock:
+            self.homes[session] = home
+        return session
+
+    def put(self, servvar, uservar, session):
+        with self.lock:
+            self.idle.setdefault((servvar, uservar), []).append(session)
+
+    # Close a session that failed instead of returning it to the pool
+    def discard(self, session):
+        with self.lock:
+            self.homes.pop(session, None)
+        session.close()
+
+    def closeAll(self):
+        with self.lock:
+            sessions = [s for idle in self.idle.values() for s in idle]
+            self.idle.clear()
+            self.homes.clear()
+        for session in sessions:
+            try:
+                session.quit()
+            except Exception:
+                session.close()
+
+ftppool = ftpPool()
+
+# Pool of authenticated SMB connections per (host, user), kept open for the whole MPFU session. Like FTP, an SMB
+# connection carries one request at a time, so each worker takes its own with get() and hands it back with put().
+class smbPool(object):
+
+    def __init__(self, port=445):
+        self.port = port
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, servvar, uservar, passvar):
+        from smb.SMBConnection import SMBConnection
+        from smb.smb_structs import OperationFailure
+
+        key = (servvar, uservar)
+        while True:
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                smbc = idle.pop() if idle else None
+            if smbc is None:
+                break
+            try:
+                smbc.echo(b'mpfu', timeout=10)
+                return smbc
+            except Exception:
+                smbc.close()
 
+        # Split off the domain if the username includes one
+        domain = ""
+        if "\\" in uservar:
+            domain, uservar = uservar.split("\\", 1)
+
+        # Get local hostname and remote IP for pysmb, and fake a NetBIOS name for the server
+        host_n = socket.gethostname()
+        start = time.monotonic()
+        target_ip = resolveHost(servvar, self.port, socket.AF_INET)[0][4][0]
+        resolved = time.monotonic()
+        netbios_n = servvar.split('.')[0].upper()
+
+        smbc = SMBConnection(uservar, passvar, host_n, netbios_n, domain=domain,
+                             use_ntlm_v2=True, is_direct_tcp=True)
+        if not smbc.connect(target_ip, self.port, timeout=args.connect_timeout):
+            smbc.close()
+            raise OperationFailure(f"Authentication to {servvar} failed", [])
+        # pysmb connects, negotiates and authenticates in one call, so it is all counted as auth
+        metrics.connected("smb", servvar, resolved - start, None, time.monotonic() - resolved)
+        return smbc
+
+    def put(self, servvar, uservar, smbc):
+        with self.lock:
+            self.idle.setdefault((servvar, uservar), []).append(smbc)
+
+    # Close a connection that failed instead of returning it to the pool
+    def discard(self, smbc):
+        smbc.close()
+
+    def closeAll(self):
+        with self.lock:
+            conns = [c for idle in self.idle.values() for c in idle]
+            self.idle.clear()
+        for smbc in conns:
+            smbc.close()
+
+smbpool = smbPool()
+
+# Local SQLite manifest of delivered files: (destination, remote path) -> content hash, size and mtime.
+# Used with --skip-sent to skip files that were already delivered unchanged, without asking the remote side.
+class transferManifest(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+        self.hashes = {}
+
+    def db(self):
+        if self.conn is None:
+            import sqlite3
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS sent (
+                dest TEXT, path TEXT, hash TEXT, size INTEGER, mtime REAL, sent REAL,
+                PRIMARY KEY (dest, path))""")
+        return self.conn
+
+    # SHA-256 of a local file, cached for the session by path, size and mtime
+    def fileHash(self, g, st):
+        import hashlib
+
+        key = (os.path.abspath(g), st.st_size, st.st_mtime)
+        if key not in self.hashes:
+            h = hashlib.sha256()
+            with open(g, 'rb') as file:
+                for block in iter(lambda: file.read(1048576), b''):
+                    h.update(block)
+            self.hashes[key] = h.hexdigest()
+        return self.hashes[key]
+
+    # True if g was already delivered to rempath at destkey with the same content
+    def delivered(self, destkey, rempath, g):
+        st = os.stat(g)
+        with self.lock:
+            row = self.db().execute("SELECT hash, size, mtime FROM sent WHERE dest = ? AND path = ?",
+                                    (destkey, rempath)).fetchone()
+            if row is None or row[1] != st.st_size:
+                return False
+            if row[2] == st.st_mtime:
+                return True
+            # Touched but maybe not changed: compare content and remember the new mtime if it matches
+            if row[0] != self.fileHash(g, st):
+                return False
+            self.db().execute("UPDATE sent SET mtime = ? WHERE dest = ? AND path = ?", (st.st_mtime, destkey, rempath))
+            self.db().commit()
+            return True
+
+    def record(self, destkey, rempath, g):
+        st = os.stat(g)
+        with self.lock:
+            self.db().execute("INSERT OR REPLACE INTO sent VALUES (?, ?, ?, ?, ?, ?)",
+                              (destkey, rempath, self.fileHash(g, st), st.st_size, st.st_mtime, time.time()))
+            self.db().commit()
+
+manifest = transferManifest(os.path.join(homepath, 'manifest.mpfu'))
+
+# Manifest key for a destination. SFTP and SCP write to the same filesystem, so they share one.
+def destKey(protvar, servvar, uservar):
+    if protvar in ("sftp", "scp"):
+        protvar = "ssh"
+    return f"{protvar}://{uservar + '@' if uservar else ''}{servvar}"
+
+# With --skip-sent, check the manifest before sending g and say so if it is skipped
+def alreadySent(destkey, rempath, g):
+    if not args.skip_sent or not manifest.delivered(destkey, rempath, g):
+        return False
+    if not isQuiet():
+        print(f"Skipping {g_}{g}{_nc}, already delivered to {b_}{destkey}{_nc}:{p_}{rempath}{_nc}")
+    return True
+
+# With --skip-sent, record a successful upload in the manifest
+def markSent(destkey, rempath, g):
+    if args.skip_sent:
+        manifest.record(destkey, rempath, g)
+
+# S3 client shared by the whole session. Its connection pool is sized for --s3-threads per destination uploading at once.
+s3_client = None
+s3_lock = threading.Lock()
+
+def s3Client():
+    global s3_client
+    with s3_lock:
+        if s3_client is None:
+            import boto3
+            from botocore.config import Config
+            pool = max(10, args.s3_threads * max(1, args.parallel))
+            # boto3 retries throttling and dropped connections itself, as many times as --retries
+            s3_client = boto3.client('s3', endpoint_url=args.s3_endpoint,
+                                     config=Config(max_pool_connections=pool,
+                                                   retries={'max_attempts': args.retries + 1, 'mode': 'standard'}))
+        return s3_client
+
+# Transfer settings for S3 uploads, from --s3-chunk and --s3-threads
+def s3TransferConfig():
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=args.s3_chunk, multipart_chunksize=args.s3_chunk,
+                          max_concurrency=args.s3_threads, use_threads=True)
+
+# Index of the objects under prefix in bucket, from one paginated listing: key -> (size, ETag)
+def s3Index(s3, bucket, prefix):
+    index = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            index[obj['Key']] = (obj['Size'], obj['ETag'].strip('"'))
+    return index
+
+# The ETag S3 gives local file g when uploaded with the current --s3-chunk settings: the MD5 of the file, or for
+# multipart uploads the MD5 of the part MD5s followed by -partcount
+def s3Etag(g):
+    import hashlib
+    from s3transfer.utils import ChunksizeAdjuster
+
+    size = os.path.getsize(g)
+    with open(g, 'rb') as file:
+        if size < args.s3_chunk:
+            h = hashlib.md5()
+            for block in iter(lambda: file.read(1048576), b''):
+                h.update(block)
+            return h.hexdigest()
+        chunk = ChunksizeAdjuster().adjust_chunksize(args.s3_chunk, size)
+        digests = [hashlib.md5(part).digest() for part in iter(lambda: file.read(chunk), b'')]
+    return hashlib.md5(b''.join(digests)).hexdigest() + f"-{len(digests)}"
 
 # Single destination upload function. Routes to protocol-specific upload worker functions.
 def mpfuUpload():
@@ -282,26 +1251,8 @@ def mpfuUpload():
 
         uservar = input("\nUsername: ")
 
-        try:
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar,
-                        timeout=8)
-            passvar = ""
-            sftpc = pssh.open_sftp()
-        except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-            print(
-                f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
-            
-            passvar = getpass.getpass('')
-
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                        timeout=8)
-            sftpc = pssh.open_sftp()
+        passvar = ""
+        sftpc = sshpool.sftp(servvar, uservar)
 
         remdirvar = input(
             "\nRemote upload directory (remote dir must be specified with leading and trailing slash): ")
@@ -317,27 +1268,8 @@ def mpfuUpload():
 
         uservar = input("\nUsername: ")
 
-        import scp
-
-        try:
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar,
-                        timeout=8)
-            passvar = ""
-            pscp = scp.SCPClient(pssh.get_transport(), progress=sbar)
-        except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-            print(
-                f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
-            passvar = getpass.getpass('')
-
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                        timeout=8)
-            pscp = scp.SCPClient(pssh.get_transport(), progress=sbar)
+        passvar = ""
+        pscp = sshpool.scp(servvar, uservar)
 
         remdirvar = input(
             "\nRemote upload directory (remote dir must be specified with leading and trailing slash): ")
@@ -374,7 +1306,7 @@ def mpfuUpload():
         servvar = "s3://"
         try:
             # Make sure bucket exists and we can connect
-            s3 = boto3.client('s3')
+            s3 = s3Client()
             s3.list_objects(Bucket=remdirvar, MaxKeys=1)
         except NoCredentialsError:
             print(f"""
@@ -414,293 +1346,507 @@ def mpfuUpload():
         return s3Upload(dirvar, filevar, fileglob, remdirvar)
 
 
-# fbar_bytes initialized in global namespace to make fbar() work
-fbar_bytes = 0
+# Bytes at the start and end of a partial remote file compared with the local file before resuming onto it
+resume_check_bytes = 262144
+
+# (start, length) windows of the first offset bytes of a size byte file that are compared before resuming at
+# offset. A remote copy that is already size bytes long is compared in full: it is only skipped if it is identical.
+def resumeWindows(offset, size):
+    check = min(offset, resume_check_bytes)
+    if offset == size or offset <= 2 * check:
+        return [(0, offset)]
+    return [(0, check), (offset - check, check)]
+
+# Whether length bytes of remote data, read with read(n) (up to n bytes a call), match local file g from start
+def matchesLocal(read, g, start, length):
+    with open(g, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = read(min(65536, length))
+            if not chunk or chunk != file.read(len(chunk)):
+                return False
+            length -= len(chunk)
+    return True
+
+# Offset to resume an FTP upload of local file g at: the size of the partial remote copy if its head and tail
+# match the local file, else 0. Returns the full size if the remote copy is already complete and identical.
+def ftpResumeOffset(session, gfile, g):
+    import ftplib
+
+    size = os.path.getsize(g)
+    try:
+        session.voidcmd('TYPE I')
+        offset = session.size(gfile) or 0
+    except ftplib.error_perm:
+        return 0
+    if offset <= 0 or offset > size:
+        return 0
+
+    # Read back each window of the partial file with REST + RETR, hanging up once enough has arrived
+    for start, length in resumeWindows(offset, size):
+        conn = session.transfercmd('RETR ' + gfile, rest=start or None)
+        same = matchesLocal(conn.recv, g, start, length)
+        conn.close()
+        try:
+            session.voidresp()
+        except (ftplib.error_temp, ftplib.error_perm):
+            pass
+        if not same:
+            return 0
+    return offset
+
+# Resume an SFTP upload of g onto a partial remote file at rempath. Returns False if there is nothing
+# to resume from (no remote file, larger, or content doesn't match) and a normal upload is needed.
+def sftpResume(sftpc, g, rempath, callback):
+    size = os.path.getsize(g)
+    try:
+        offset = sftpc.stat(rempath).st_size
+    except IOError:
+        return False
+    if offset <= 0 or offset > size:
+        return False
+
+    with sftpc.open(rempath, 'rb') as remfile:
+        for start, length in resumeWindows(offset, size):
+            remfile.seek(start)
+            if not matchesLocal(remfile.read, g, start, length):
+                return False
+
+    if offset == size:
+        print(f"Remote copy of {g_}{g}{_nc} is already complete")
+        return True
+    print(f"Resuming {g_}{g}{_nc} at byte {y_}{offset}{_nc} of {y_}{size}{_nc} =>")
+    with open(g, 'rb') as file, sftpc.open(rempath, 'r+b') as remfile:
+        file.seek(offset)
+        remfile.seek(offset)
+        remfile.set_pipelined(True)
+        sent = offset
+        for block in iter(lambda: file.read(32768), b''):
+            remfile.write(block)
+            sent += len(block)
+            callback(sent, size)
+    return True
+
+# Upload one large file as --streams byte ranges written at their offsets over separate pooled SSH sessions
+# to the same host, so the transfer isn't capped by a single channel's window and round trip time
+def sftpMultiStream(servvar, uservar, passvar, g, rempath, callback):
+    size = os.path.getsize(g)
+    streams = max(1, args.streams)
+    span = -(-size // streams)
+    sent = 0
+    sentlock = threading.Lock()
+
+    # Create (or truncate) the target once so every stream can open it for writing in place
+    sftpc = sshpool.sftp(servvar, uservar, passvar)
+    sftpc.open(rempath, 'wb').close()
+
+    def sendRange(slot):
+        nonlocal sent
+        start, end = slot * span, min(size, (slot + 1) * span)
+        rangesftp = sshpool.sftp(servvar, uservar, passvar, slot=slot)
+        blocksize = fast_request_size if isFast(servvar) else 32768
+        with open(g, 'rb') as file, rangesftp.open(rempath, 'r+b') as remfile:
+            file.seek(start)
+            remfile.seek(start)
+            remfile.MAX_REQUEST_SIZE = blocksize
+            remfile.set_pipelined(True)
+            pos = start
+            while pos < end:
+                block = file.read(min(blocksize, end - pos))
+                remfile.write(block)
+                pos += len(block)
+                with sentlock:
+                    sent += len(block)
+                    callback(sent, size)
+        rangesftp.close()
+
+    print(f"Sending in {y_}{streams}{_nc} parallel streams =>")
+    with ThreadPoolExecutor(max_workers=streams) as pool:
+        for future in [pool.submit(sendRange, slot) for slot in range(streams) if slot * span < size]:
+            future.result()
+
+    remsize = sftpc.stat(rempath).st_size
+    sftpc.close()
+    if remsize != size:
+        raise IOError(f"size mismatch after multi-stream upload of {g}: sent {size} bytes, remote has {remsize}")
+    return True
 
 def ftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob):
     import ftplib
 
-    # Modified progress provider for ftplib. fbar_bytes set to 0 initially to make func work
-    def fbar(ftpbytes):
-        global fbar_bytes
-        total_bytes = bar_f_size
-        fbar_bytes += 8192
-        bar_length = 35
-        percent = float(fbar_bytes) / total_bytes
-        hashes = '#' * int(round(percent * bar_length))
-        spaces = ' ' * (bar_length - len(hashes))
-        message = "\rSize: " + str(total_bytes) + " bytes("\
-                + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-        message += " || Amount of file transferred: [{0}] {1}%\r".format(hashes + spaces,
-                                                                        round(percent * 100, 2))
-        if fbar_bytes >= total_bytes:
-            message = "\rSize: " + str(total_bytes) + " bytes("\
-                    + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-            message += " || File transferred. [{0}] {1}%                    \r"\
-                    .format(hashes + spaces, round(percent * 100))
-            fbar_bytes = 0
-        sys.stdout.write(message)
-        sys.stdout.flush()
+    # Send local file g into the current directory of session. With shared set, progress for the whole upload
+    # was registered by the caller.
+    def ftpSend(session, ftp_pwd, g, shared):
+        gfile = str(os.path.basename(g))
+        size = os.path.getsize(g)
+        if alreadySent(destkey, ftp_pwd.rstrip('/') + '/' + gfile, g):
+            if shared:
+                progress.update(size)
+            return
+        offset = ftpResumeOffset(session, gfile, g) if args.resume else 0
+        if offset and offset == size:
+            print(f"Remote copy of {g_}{g}{_nc} is already complete")
+            markSent(destkey, ftp_pwd.rstrip('/') + '/' + gfile, g)
+            if shared:
+                progress.update(size)
+            return
+        print(
+            f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{ftp_pwd}{_nc} over {y_}{protvar.upper()}{_nc} =>")
+        if offset:
+            print(f"Resuming at byte {y_}{offset}{_nc} of {y_}{size}{_nc}")
+        if not shared:
+            progress.begin(size)
+        timer = metrics.start(protvar.lower(), servvar, g)
+        try:
+            progress.update(offset)
+            with open(g, 'rb') as file:
+                file.seek(offset)
+                session.storbinary('STOR ' + gfile, file, blocksize=min(args.ftp_block, max(size - offset, 8192)),
+                                   callback=timer.wrap(lambda block: progress.update(len(block))), rest=offset or None)
+        finally:
+            if not shared:
+                progress.end()
+        timer.done(size - offset)
+        markSent(destkey, ftp_pwd.rstrip('/') + '/' + gfile, g)
+
+    # Open a session from the pool in the upload directory
+    def ftpSession():
+        session = ftppool.get(servvar, uservar, passvar)
+        try:
+            if remdirvar != "":
+                session.sendcmd(f'cwd {remdirvar}')
+            return session, ftplib.parse257(session.sendcmd('pwd'))
+        except ftplib.all_errors:
+            ftppool.discard(session)
+            raise
+
+    # Worker for --ftp-sessions: one pooled session sending files from the shared queue until it's empty
+    def ftpWorker(queue):
+        session, ftp_pwd = ftpSession()
+        try:
+            while True:
+                with queuelock:
+                    if not queue:
+                        break
+                    g = queue.pop(0)
+                ftpSend(session, ftp_pwd, g, True)
+        except BaseException:
+            ftppool.discard(session)
+            raise
+        ftppool.put(servvar, uservar, session)
+
     try:
-        session = ftplib.FTP_TLS()
-        session.connect(servvar, 21)
-        session.sendcmd(f'USER {uservar}')
-        session.sendcmd(f'PASS {passvar}')
-        if remdirvar != "":
-            session.sendcmd(f'cwd {remdirvar}')
-        resp_pwd = session.sendcmd('pwd')
-        ftp_pwd = resp_pwd.lstrip('0123456789" ').rstrip('"')
-        if plat_type == 'Linux':
-            os.system('setterm -cursor off')
-        for g in fileglob:
-            if os.path.isdir(g):
-                continue
-            gfile = str(os.path.basename(g))
-            file = open(f'{g}', 'rb')
-            global bar_f_size
-            global transfered_bytes
-            transfered_bytes = 0
-            bar_f_size = os.path.getsize(g)
-            if remdirvar == "":
-                remdirvar = "[default]"
-            print(
-                f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{ftp_pwd}{_nc} over {y_}{protvar.upper()}{_nc} =>")
-            session.storbinary('STOR ' + gfile, file, callback=fbar)
-            print("\n\n")
-            file.close()
-        session.quit()
-        if plat_type == 'Linux':
-            os.system('setterm -cursor on')
+        destkey = destKey(protvar, servvar, uservar)
+        files = [g for g in fileglob if not os.path.isdir(g)]
+        sessions = max(1, min(args.ftp_sessions, len(files)))
+        if sessions == 1:
+            session, ftp_pwd = ftpSession()
+            try:
+                for g in files:
+                    ftpSend(session, ftp_pwd, g, False)
+            except BaseException:
+                ftppool.discard(session)
+                raise
+            ftppool.put(servvar, uservar, session)
+        else:
+            # Largest files first, so no session is left with one big file at the end
+            queue = sorted(files, key=os.path.getsize, reverse=True)
+            queuelock = threading.Lock()
+            print(f"Sending over {y_}{sessions}{_nc} parallel sessions =>")
+            progress.begin(sum(os.path.getsize(g) for g in files))
+            try:
+                with ThreadPoolExecutor(max_workers=sessions) as pool:
+                    for future in [pool.submit(ftpWorker, queue) for _ in range(sessions)]:
+                        future.result()
+            finally:
+                progress.end()
+        return True
     except ftplib.all_errors as e:
         print(f"""
 {r_}<ERROR>
 The server raised an exception: {e} {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
 
 
 def sftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, sftpc):
 
-    # Transfer progress provider from https://github.com/jonDel/ssh_paramiko
-    def pbar(transfered_bytes, total_bytes):
-        bar_length = 35
-        percent = float(transfered_bytes) / total_bytes
-        hashes = '#' * int(round(percent * bar_length))
-        spaces = ' ' * (bar_length - len(hashes))
-        message = "\rSize: " + str(total_bytes) + " bytes("\
-                + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-        message += " || Amount of file transferred: [{0}] {1}%\r".format(hashes + spaces,
-                                                                        round(percent * 100, 2))
-        if transfered_bytes == total_bytes:
-            message = "\rSize: " + str(total_bytes) + " bytes("\
-                    + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-            message += " || File transferred. [{0}] {1}%                    \r"\
-                    .format(hashes + spaces, round(percent * 100, 2))
-        sys.stdout.write(message)
-        sys.stdout.flush()
-
     try:
-        if plat_type == 'Linux':
-            os.system('setterm -cursor off')
+        destkey = destKey(protvar, servvar, uservar)
         for g in fileglob:
             if os.path.isdir(g):
                 continue
             gfile = str(os.path.basename(g))
+            if alreadySent(destkey, remdirvar + gfile, g):
+                continue
             print(f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
-            sftpc.put(g, remdirvar + gfile, callback=pbar)
-            print("\n\n")
+            timer = metrics.start(protvar.lower(), servvar, g)
+            pbar = timer.wrap(progress.cumulative())
+            progress.begin(os.path.getsize(g))
+            try:
+                if args.resume and sftpResume(sftpc, g, remdirvar + gfile, pbar):
+                    pass
+                elif args.streams > 1 and os.path.getsize(g) >= args.stream_threshold:
+                    sftpMultiStream(servvar, uservar, passvar, g, remdirvar + gfile, pbar)
+                else:
+                    sftpPut(sftpc, servvar, g, remdirvar + gfile, callback=pbar)
+            finally:
+                progress.end()
+            timer.done(os.path.getsize(g))
+            markSent(destkey, remdirvar + gfile, g)
         sftpc.close()
-        if plat_type == 'Linux':
-            os.system('setterm -cursor on')
-    except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType):
+        return True
+    except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType) as e:
         print(f"""
 {r_}<ERROR>
 Username, password, or SSH key are incorrect, or the server is not accepting the type of authentication attempted{_nc}.\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
-    except (BlockingIOError, socket.timeout):
+        transferFailed(e)
+        return False
+    except (BlockingIOError, socket.timeout) as e:
         print(f"""
 {r_}<ERROR>
 Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
     except socket.gaierror as e:
         print(f"""
 {r_}<ERROR>
 The server raised an exception: {e} {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
 
     
 def scpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, pscp):
+    import scp
 
     try:
-        if plat_type == 'Linux':
-            os.system('setterm -cursor off')
+        destkey = destKey(protvar, servvar, uservar)
+        sendlist = []
         for g in fileglob:
             if os.path.isdir(g):
                 continue
             gfile = str(os.path.basename(g))
+            if alreadySent(destkey, remdirvar + gfile, g):
+                continue
             print(
                 f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
-            pscp.put(g, remote_path=remdirvar)
-            print("\n\n")
+            sendlist.append(g)
+        # The whole selection goes through one remote scp process instead of one per file
+        if sendlist:
+            progress.begin(sum(os.path.getsize(g) for g in sendlist))
+            threadstate.scp_host = (protvar.lower(), servvar)
+            try:
+                pscp.put(sendlist, remote_path=remdirvar)
+            finally:
+                threadstate.scp_host = None
+                progress.end()
+            for g in sendlist:
+                markSent(destkey, remdirvar + str(os.path.basename(g)), g)
         pscp.close()
-        if plat_type == 'Linux':
-            os.system('setterm -cursor on')
-    except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType):
+        return True
+    except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType) as e:
         print(f"""
 {r_}<ERROR>
 Username, password, or SSH key are incorrect, or the server is not accepting the type of authentication attempted{_nc}.\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
-    except (BlockingIOError, socket.timeout):
+        transferFailed(e)
+        return False
+    except (BlockingIOError, socket.timeout) as e:
         print(f"""
 {r_}<ERROR>
 Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
     except scp.SCPException as e:
         print(f"""
 {r_}<ERROR>
 The server raised an exception: {e} {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
     except socket.gaierror as e:
         print(f"""
 {r_}<ERROR>
 The server raised an exception: {e} {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
+
+# Share name and path on the share from a /share/path/ remote dir. The path always starts and ends with a slash.
+def smbPath(remdirvar):
+    parts = remdirvar.replace('\\\\', '/').replace('\\', '/').split('/')
+    share_n = parts[1]
+    path_n = '/'.join(p for p in parts[2:] if p)
+    return share_n, '/' + path_n + '/' if path_n else '/'
+
+# Timeout for storing a file of size bytes, so large files over slow links get as long as they need
+def smbTimeout(size):
+    return 60 + size / max(1, args.smb_min_rate)
+
+# Store files on an SMB share over up to --smb-sessions pooled connections at once. jobs is a list of
+# (local file, path on the share); done(local file, path) is called as each file completes.
+def smbStore(servvar, uservar, passvar, share_n, jobs, done):
+    # Largest files first, so no connection is left with one big file at the end
+    queue = sorted(jobs, key=lambda job: os.path.getsize(job[0]), reverse=True)
+    queuelock = threading.Lock()
+
+    def storeWorker():
+        smbc = smbpool.get(servvar, uservar, passvar)
+        try:
+            while True:
+                with queuelock:
+                    if not queue:
+                        break
+                    g, rempath = queue.pop(0)
+                timer = metrics.start("smb", servvar, g)
+                with open(g, 'rb') as file:
+                    smbc.storeFile(share_n, rempath, file, timeout=smbTimeout(os.path.getsize(g)))
+                timer.done(os.path.getsize(g))
+                done(g, rempath)
+        except BaseException:
+            smbpool.discard(smbc)
+            raise
+        smbpool.put(servvar, uservar, smbc)
+
+    sessions = max(1, min(args.smb_sessions, len(queue)))
+    with ThreadPoolExecutor(max_workers=sessions) as pool:
+        for future in [pool.submit(storeWorker) for _ in range(sessions)]:
+            future.result()
 
 def smbUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob):
-    from smb.SMBConnection import SMBConnection
     from smb.smb_structs import OperationFailure
-    from halo import Halo
+    from smb.base import NotConnectedError, NotReadyError, SMBTimeout
 
     try:
-        # Sanitize username in case of domain inclusion
-        if "\\" in uservar:
-            uservar = uservar.split("\\")[1]
-            domain = uservar.split("\\")[0]
+        # Extract service name and path from input
+        share_n, path_n = smbPath(remdirvar)
 
-        # Get local hostname and remote IP for pysmb
-        host_n = socket.gethostname()
-        target_ip = socket.gethostbyname(servvar)
-
-        # Fake a NetBIOS name
-        netbios_n = servvar.split('.')
-        netbios_n = netbios_n[0].upper()
-
-        # Extract service name from input
-        share_n = remdirvar.replace(
-            '\\\\', '/').replace('\\', '/').split('/')[1].replace('/', '')
-
-        # Extract path from input
-        path_n = remdirvar.replace(
-            '\\\\', '/').replace('\\', '/').split('/')[2:]
-        path_n = '/' + '/'.join(path_n)
-
-        # Establish actual SMB connection
-        smbc = SMBConnection(uservar, passvar, host_n,
-                                netbios_n, use_ntlm_v2=True, is_direct_tcp=True)
-        assert smbc.connect(target_ip, 445)
-
-        if plat_type == 'Linux':
-            os.system('setterm -cursor off')
+        destkey = destKey(protvar, servvar, uservar)
+        jobs = []
         for g in fileglob:
             if os.path.isdir(g):
                 continue
             gfile = str(os.path.basename(g))
+            if alreadySent(destkey, '/' + share_n + path_n + gfile, g):
+                continue
             print(
                 f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
-            sizedisplay = "Size: " + str(os.path.getsize(g)) + " bytes(" + str(
-                round(float(os.path.getsize(g)) / pow(2, 20), 2)) + " MB) ||"
-            spinner = Halo(text=sizedisplay, placement='right',
-                            color='yellow', spinner='dots')
-            spinner.start()
-            with open(g, 'rb') as file:
-                smbc.storeFile(share_n, path_n + gfile, file, timeout=15)
-
-            if plat_type == 'Windows':
-                spinner.stop_and_persist(
-                    '√', sizedisplay + ' Transfer complete.')
-            elif plat_type == 'Linux':
-                spinner.succeed(sizedisplay + ' Transfer complete.')
-            print("\n")
-        if plat_type == 'Linux':
-            os.system('setterm -cursor on')
-        print("\n")
-    except (socket.gaierror, socket.timeout):
+            jobs.append((g, path_n + gfile))
+        if not jobs:
+            return True
+
+        # pysmb has no progress callback, so progress moves as each file lands on the share
+        def smbDone(g, rempath):
+            progress.update(os.path.getsize(g))
+            markSent(destkey, '/' + share_n + rempath, g)
+
+        progress.begin(sum(os.path.getsize(g) for g, _ in jobs))
+        try:
+            smbStore(servvar, uservar, passvar, share_n, jobs, smbDone)
+        finally:
+            progress.end()
+        return True
+    except (socket.gaierror, socket.timeout, SMBTimeout) as e:
         print(f"""
 {r_}<ERROR>
 Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
 
-    except OperationFailure:
+    except (OperationFailure, NotConnectedError, NotReadyError) as e:
         print(f"""
 {r_}<ERROR>
 Unable to connect to share. Permissions may be invalid or share name may be wrong.
 Please use the following format (do NOT include server name): {p_}/share/path/to/target/ {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
 
 
-def s3Upload(dirvar, filevar, fileglob, remdirvar):
+# With copyfrom set to a bucket that already holds the files, they are copied server-side from it instead of uploaded,
+# falling back to a normal upload for any file the copy is refused for
+def s3Upload(dirvar, filevar, fileglob, remdirvar, copyfrom=None):
 
     import boto3
+    from boto3.s3.transfer import create_transfer_manager
+    from s3transfer.subscribers import BaseSubscriber
     from botocore.exceptions import NoCredentialsError, ClientError
 
-    # Modified progress provider for S3. boto3 only sends transferred bytes each update.
-    def s3bar(t_bytes):
-        global s3_bytes
-        s3_bytes += t_bytes
-        bar_length = 35
-        percent = float(s3_bytes) / s3_f_size
-        hashes = '#' * int(round(percent * bar_length))
-        spaces = ' ' * (bar_length - len(hashes))
-        message = "\rSize: " + str(s3_f_size) + " bytes("\
-                + str(round(float(s3_f_size) / pow(2, 20), 2)) + " MB)"
-        message += " || Amount of file transferred: [{}] {}%\r".format(hashes + spaces,
-                                                                    round(percent * 100, 2))
-        if s3_bytes == s3_f_size:
-            message = "\rSize: " + str(s3_f_size) + " bytes("\
-                    + str(round(float(s3_f_size) / pow(2, 20), 2)) + " MB)"
-            message += " || File transferred. [{}] {}%                    \r"\
-                    .format(hashes + spaces, round(percent * 100, 2))
-        sys.stdout.write(message)
-        sys.stdout.flush()
-
     try:
-        s3 = boto3.client('s3')
-        if plat_type == 'Linux':
-            os.system('setterm -cursor off')
+        s3 = s3Client()
+        destkey = destKey("s3", remdirvar, "")
+        sendlist = []
+
+        # With --s3-skip, list the keys about to be written once instead of asking about each object
+        s3index = {}
+        if args.s3_skip:
+            keys = [os.path.basename(g) for g in fileglob if not os.path.isdir(g)]
+            s3index = s3Index(s3, remdirvar, os.path.commonprefix(keys)) if keys else {}
+
         for g in fileglob:
             if os.path.isdir(g):
                 continue
             gfile = str(os.path.basename(g))
-            global s3_f_size
-            s3_f_size = os.path.getsize(g)
-            global s3_bytes
-            s3_bytes = 0
-            print(
-                f"Sending {g_}{g}{_nc} to {b_}s3://{_nc}:{p_}{remdirvar}{_nc} over {y_}HTTPS{_nc} =>")
-            s3.upload_file(g, remdirvar, gfile, Callback=s3bar)
-            print("\n\n")
-        if plat_type == 'Linux':
-            os.system('setterm -cursor on')
-    except NoCredentialsError:
+            if alreadySent(destkey, gfile, g):
+                continue
+            if gfile in s3index and s3index[gfile][0] == os.path.getsize(g) and s3index[gfile][1] == s3Etag(g):
+                if not isQuiet():
+                    print(f"Skipping {g_}{g}{_nc}, unchanged in {b_}s3://{_nc}:{p_}{remdirvar}{_nc}")
+                markSent(destkey, gfile, g)
+                continue
+            if copyfrom:
+                print(f"Copying {g_}{gfile}{_nc} from {b_}s3://{_nc}:{p_}{copyfrom}{_nc} to {b_}s3://{_nc}:{p_}{remdirvar}{_nc} =>")
+            else:
+                print(
+                    f"Sending {g_}{g}{_nc} to {b_}s3://{_nc}:{p_}{remdirvar}{_nc} over {y_}HTTPS{_nc} =>")
+            sendlist.append((g, gfile))
+
+        if not sendlist:
+            return True
+
+        # One transfer manager for all files, so whole files and parts of large files share the same thread pool.
+        # Large objects are copied in parts (UploadPartCopy) with the same chunk size they would be uploaded with.
+        progress.begin(sum(os.path.getsize(g) for g, _ in sendlist))
+        try:
+            with create_transfer_manager(s3, s3TransferConfig()) as manager:
+                # Times each file from its own transfer's callbacks, from when it is queued on the manager (so time
+                # waiting for a free thread counts) to when it is done, whatever order the futures are collected in
+                class s3Timing(BaseSubscriber):
+
+                    def __init__(self, g):
+                        self.g = g
+                        self.timer = None
+
+                    def on_queued(self, future, **kwargs):
+                        self.timer = metrics.start("s3", remdirvar, self.g)
+
+                    def on_progress(self, future, bytes_transferred, **kwargs):
+                        self.timer.first()
+                        progress.update(bytes_transferred)
+
+                    def on_done(self, future, **kwargs):
+                        try:
+                            future.result()
+                        except Exception:
+                            return
+                        self.timer.done(os.path.getsize(self.g))
+
+                def s3Send(g, gfile):
+                    if copyfrom:
+                        return manager.copy({'Bucket': copyfrom, 'Key': gfile}, remdirvar, gfile,
+                                            subscribers=[s3Timing(g)])
+                    return manager.upload(g, remdirvar, gfile, subscribers=[s3Timing(g)])
+
+                futures = [(g, gfile, s3Send(g, gfile)) for g, gfile in sendlist]
+                for g, gfile, future in futures:
+                    try:
+                        future.result()
+                    except ClientError as e:
+                        if not copyfrom:
+                            raise
+                        print(f"{y_}Copy of {gfile} refused ({e.response['Error']['Code']}), uploading it instead{_nc}")
+                        manager.upload(g, remdirvar, gfile, subscribers=[s3Timing(g)]).result()
+                    markSent(destkey, gfile, g)
+        finally:
+            progress.end()
+        return True
+    except NoCredentialsError as e:
         print(f"""
 {r_}Could not determine valid credentials for AWS{_nc}.
 
@@ -714,26 +1860,769 @@ To install {y_}awscli{_nc} through Python:
 
 pip install awscli\n""")
 
-        input("Press a key to continue...")
-        print(" ")
-        return
+        transferFailed(e)
+        return False
     except ClientError as e:
         if e.response['Error']['Code'] == "NoSuchBucket" or "AccessDenied":
             print(f"""
 {r_}<ERROR>
 Bucket name doesn't exist or access was denied. Check the bucket name and your permissions and try again.{_nc}
     """)
-            input("Press a key to continue...")
-            print(" ")
-            return
+            transferFailed(e)
+            return False
         elif e.response['Error']['Code'] != "":
             print(f"""
 {r_}<ERROR>
 Unknown error. Check your credentials and bucketname and try again.{_nc}
 """)
-            input("Press a key to continue...")
-            print(" ")
-            return
+            transferFailed(e)
+            return False
+
+# Destination tuple (protocol, host, remote path or bucket, user, password). A protocol of sftp+fast opts the host
+# into the fast transport profile.
+def makeDest(protvar, servvar, remdirvar, uservar, passvar):
+    if protvar.endswith("+fast"):
+        protvar = protvar[:-len("+fast")]
+        fast_hosts.add(servvar)
+    if protvar == "s3":
+        return (protvar, "", remdirvar, "", "")
+    return (protvar, servvar, remdirvar, uservar, passvar)
+
+# Parse serverlist entries (protocol:host:/remote/path/:user:password or s3:bucket) into destination tuples.
+# The password is the last field, so it may contain colons. User and password may be left off, as for SSH key
+# logins; like the structured inventory formats, an entry missing anything else raises ValueError naming it.
+def parseDests(entries):
+    dests = []
+    for entry in entries:
+        if entry.strip() == "":
+            continue
+        elem = [e.strip() for e in entry.split(":", 4)]
+        if elem[0] == "s3":
+            if len(elem) < 2 or not elem[1]:
+                raise ValueError(f"serverlist entry has no bucket: {entry.strip()!r}")
+            dests.append(makeDest(elem[0], "", elem[1], "", ""))
+        else:
+            if len(elem) < 3 or not elem[0] or not elem[1]:
+                raise ValueError(f"serverlist entry needs at least protocol:host:/remote/path/: {entry.strip()!r}")
+            elem += [""] * (5 - len(elem))
+            dests.append(makeDest(elem[0], elem[1], elem[2], elem[3], elem[4]))
+    return dests
+
+# Group or tag names from an inventory field: a list, or a string separated by commas or semicolons
+def inventoryLabels(value):
+    if value is None or value == "":
+        return []
+    if isinstance(value, str):
+        value = value.replace(';', ',').split(',')
+    return [str(v).strip() for v in value if str(v).strip()]
+
+# Inventory host from a YAML/TOML mapping or CSV row, with defaults filled in. Fields: protocol, host, path (or
+# bucket for s3), user, password, groups, tags and fast. Returns (dest, groups, tags).
+def inventoryHost(entry, defaults):
+    if not isinstance(entry, dict):
+        raise ValueError(f"inventory host entry is not a mapping: {entry!r}")
+    fields = dict(defaults)
+    fields.update({k: v for k, v in entry.items() if v is not None and v != ""})
+    get = lambda name: str(fields.get(name, "")).strip()
+    protvar = get('protocol')
+    if not protvar:
+        raise ValueError(f"inventory host entry has no protocol: {entry!r}")
+    if protvar != "s3" and not get('host'):
+        raise ValueError(f"inventory host entry has no host: {entry!r}")
+    if str(fields.get('fast', '')).lower() in ('true', 'yes', '1'):
+        protvar = protvar + "+fast" if not protvar.endswith("+fast") else protvar
+    dest = makeDest(protvar, get('host'), get('bucket') or get('path'), get('user'), get('password'))
+    return dest, inventoryLabels(fields.get('groups')), inventoryLabels(fields.get('tags'))
+
+# Hosts from a parsed YAML or TOML document: a list of host mappings, or a mapping with a hosts list, optional
+# defaults for every host, and optional groups mapping group names to member host names
+def inventoryDoc(doc):
+    if isinstance(doc, list):
+        doc = {'hosts': doc}
+    if not isinstance(doc, dict):
+        raise ValueError("inventory must be a list of hosts or a mapping with a 'hosts' list")
+    defaults = doc.get('defaults') or {}
+    hosts = [inventoryHost(entry, defaults) for entry in doc.get('hosts') or []]
+    members = {}
+    for group, names in (doc.get('groups') or {}).items():
+        for name in inventoryLabels(names):
+            members.setdefault(name, []).append(str(group))
+    return [(dest, groups + members.get(dest[1] or dest[2], []), tags) for dest, groups, tags in hosts]
+
+# Hosts from a serverlist in the colon format, one entry per line. A [name] or [name, name] line puts the entries
+# below it in those groups; lines starting with # are comments.
+def inventoryColon(text):
+    hosts = []
+    groups = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            groups = inventoryLabels(line[1:-1])
+            continue
+        hosts.append((parseDests([line])[0], groups, []))
+    return hosts
+
+# Serverlist parsed once into destinations, with an index from every group, tag and host name to the positions of
+# its hosts, so --target selections don't scan the whole list
+class hostInventory(object):
+
+    def __init__(self, hosts):
+        self.dests = [dest for dest, _, _ in hosts]
+        self.index = {}
+        for i, (dest, groups, tags) in enumerate(hosts):
+            for name in set(groups + tags + [dest[1] or dest[2]]):
+                self.index.setdefault(name, []).append(i)
+
+    # Destinations matching any of targets, in serverlist order. Each target is a comma separated list of names
+    # (groups, tags or hosts) that a destination must all match, i.e. web,eu-west is the web hosts in eu-west.
+    def select(self, targets):
+        chosen = set()
+        for target in targets:
+            names = inventoryLabels(target)
+            for name in names:
+                if name not in self.index:
+                    raise ValueError(f"no group, tag or host named '{name}' in the serverlist")
+            if names:
+                chosen |= set.intersection(*[set(self.index[name]) for name in names])
+        return [self.dests[i] for i in sorted(chosen)]
+
+# Parsed serverlists by path, with the modification time and size they were read at
+inventories = {}
+
+# Read a serverlist, by extension: .yaml/.yml (needs PyYAML), .toml, .csv (header row with the host fields),
+# anything else the colon format. Parsed once per MPFU session and again only if the file changes.
+def loadInventory(path):
+    path = os.path.abspath(os.path.expanduser(path))
+    st = os.stat(path)
+    cached = inventories.get(path)
+    if cached and cached[0] == (st.st_mtime, st.st_size):
+        return cached[1]
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.yaml', '.yml'):
+        import yaml
+        with open(path, 'r') as inv_file:
+            hosts = inventoryDoc(yaml.safe_load(inv_file))
+    elif ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(path, 'rb') as inv_file:
+            hosts = inventoryDoc(tomllib.load(inv_file))
+    elif ext == '.csv':
+        import csv
+        with open(path, 'r', newline='') as inv_file:
+            hosts = [inventoryHost({k.strip().lower(): v for k, v in row.items() if k}, {})
+                     for row in csv.DictReader(inv_file)]
+    else:
+        with open(path, 'r') as inv_file:
+            hosts = inventoryColon(inv_file.read())
+
+    inventory = hostInventory(hosts)
+    inventories[path] = ((st.st_mtime, st.st_size), inventory)
+    return inventory
+
+# Destinations from the --list serverlist, narrowed to --target if given
+def listDests():
+    fast_hosts.clear()
+    inventory = loadInventory(args.list)
+    return inventory.select(args.target) if args.target else list(inventory.dests)
+
+# When one upload goes to several S3 buckets, the files leave this machine once: the first bucket is uploaded to
+# and the others are filled by server-side copy from it once it's done. Shared by the workers of one fan-out.
+class s3Relay(object):
+    def __init__(self, dests):
+        buckets = [d[2] for d in dests if d[0] == "s3"]
+        self.source = buckets[0] if len(set(buckets)) > 1 else None
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.ok = False
+
+    # Upload to bucket, or copy into it from the source bucket if that upload succeeded
+    def upload(self, dirvar, filevar, fileglob, bucket):
+        if self.source is None:
+            return s3Upload(dirvar, filevar, fileglob, bucket)
+        if bucket == self.source:
+            self.started.set()
+            try:
+                self.ok = s3Upload(dirvar, filevar, fileglob, bucket)
+            finally:
+                self.done.set()
+            return self.ok
+        # The source's upload never starts if the circuit breaker skips its bucket; upload directly then
+        while not self.done.wait(1):
+            if not self.started.is_set() and breaker.isOpen(breakerKey(("s3", "", self.source))):
+                break
+        return s3Upload(dirvar, filevar, fileglob, bucket, copyfrom=self.source if self.ok else None)
+
+# Upload the selected files to a single destination. Returns True if every file was sent.
+def uploadDest(dest, dirvar, filevar, fileglob, relay=None):
+    protvar, servvar, remdirvar, uservar, passvar = dest
+
+    if protvar == "ftp":
+        print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
+        return ftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob)
+    elif protvar == "sftp":
+        print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
+        sftpc = sshpool.sftp(servvar, uservar, passvar)
+        return sftpUpload(protvar, servvar, uservar, passvar,
+                          dirvar, filevar, remdirvar, fileglob, sftpc)
+    elif protvar == "scp":
+        pscp = sshpool.scp(servvar, uservar, passvar)
+        print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
+        return scpUpload(protvar, servvar, uservar, passvar,
+                         dirvar, filevar, remdirvar, fileglob, pscp)
+    elif protvar == "smb":
+        print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
+        return smbUpload(protvar, servvar, uservar, passvar,
+                         dirvar, filevar, remdirvar, fileglob)
+    elif protvar == "s3":
+        print(f"Starting transfers to {y_}s3://{_nc}:{p_}{remdirvar}{_nc}: \n")
+        if relay:
+            return relay.upload(dirvar, filevar, fileglob, remdirvar)
+        return s3Upload(dirvar, filevar, fileglob, remdirvar)
+    else:
+        raise ValueError(f"unknown protocol '{protvar}'")
+
+# Retries (--retries) and the per-host circuit breaker (--breaker) for serverlist runs. A destination that fails with
+# a transient error is tried again after a jittered exponential backoff; a host that keeps failing is given up on,
+# so the rest of its destinations fail at once rather than each waiting out its own timeouts.
+
+# errno values of network errors worth another attempt
+transient_errnos = {errno.ECONNREFUSED, errno.ECONNRESET, errno.ECONNABORTED, errno.EHOSTUNREACH, errno.ENETUNREACH,
+                    errno.ENETDOWN, errno.ETIMEDOUT, errno.EPIPE}
+
+# paramiko raises plain SSHException for broken connections and failed logins alike ("No authentication methods
+# available"), so only these messages, of a dropped or stalled transport, are worth another attempt
+transient_ssh_messages = ('banner', 'not active', 'connection dropped', 'no existing session', 'channel closed',
+                          'timed out', 'timeout', 'eof', 'reset by peer')
+
+# Whether a failure is likely to go away on retry. Exceptions of the optional protocol modules are matched by class
+# name, so none of them has to be imported here. Authentication, permission and missing file errors are permanent.
+def isTransient(e):
+    import ftplib
+
+    if e is None or isinstance(e, ftplib.error_perm):
+        return False
+    if isinstance(e, ftplib.error_temp):
+        return True
+    if isinstance(e, socket.gaierror):
+        return e.errno == socket.EAI_AGAIN
+    names = {cls.__name__ for cls in type(e).__mro__}
+    if names & {'AuthenticationException', 'BadHostKeyException', 'PermissionDenied', 'HostKeyNotVerifiable',
+                'ClientError', 'NoCredentialsError', 'OperationFailure'}:
+        return False
+    if names & {'TimeoutError', 'NoValidConnectionsError', 'ConnectionLost', 'SFTPConnectionLost',
+                'NotConnectedError', 'NotReadyError', 'SMBTimeout'}:
+        return True
+    if 'SSHException' in names:
+        return any(msg in str(e).lower() for msg in transient_ssh_messages)
+    if isinstance(e, (socket.timeout, TimeoutError, ConnectionError, EOFError, BlockingIOError)):
+        return True
+    return isinstance(e, OSError) and e.errno in transient_errnos
+
+# Consecutive transient failures per host. --breaker failures in a row open the circuit: the host is skipped until
+# --breaker-reset seconds have passed, then one attempt is let through to see whether it is back.
+class circuitBreaker(object):
+
+    def __init__(self):
+        self.failures = {}
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def allow(self, host):
+        with self.lock:
+            if args.breaker <= 0 or self.failures.get(host, 0) < args.breaker:
+                return True
+            if time.monotonic() - self.opened[host] < args.breaker_reset:
+                return False
+            # Half open: this attempt goes ahead, the others wait out another --breaker-reset
+            self.opened[host] = time.monotonic()
+            return True
+
+    # Whether host would be skipped right now. Unlike allow, this doesn't use up a half-open attempt.
+    def isOpen(self, host):
+        with self.lock:
+            return (args.breaker > 0 and self.failures.get(host, 0) >= args.breaker
+                    and time.monotonic() - self.opened[host] < args.breaker_reset)
+
+    def success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if args.breaker > 0 and self.failures[host] >= args.breaker:
+                self.opened[host] = time.monotonic()
+
+    def reason(self, host):
+        return f"{host} failed {self.failures.get(host, 0)} times in a row, skipped (circuit open)"
+
+breaker = circuitBreaker()
+
+# Host the circuit breaker counts a destination against; for S3, which has no host per destination, the bucket
+def breakerKey(dest):
+    return dest[1] or f"s3://{dest[2]}"
+
+# Seconds to wait before retry number n (from 1): full jitter over an exponential backoff capped at 30 seconds
+def retryDelay(n):
+    import random
+    return random.uniform(0, min(30, args.retry_delay * 2 ** (n - 1)))
+
+def retryNote(dest, e, n, delay):
+    print(f"{y_}{breakerKey(dest)}: {e or 'failed'}. Retry {n}/{args.retries} in {delay:.1f}s{_nc}")
+
+# Call attempt() for dest until it succeeds, fails permanently, runs out of --retries or trips the breaker.
+# attempt returns a truthy result on success; it fails by raising or by returning a falsy one after transferFailed.
+# Returns (result, error), error being None when the cause wasn't recorded. Raised errors are printed if echo is set.
+def retryCall(dest, attempt, echo=True):
+    host = breakerKey(dest)
+    if not breaker.allow(host):
+        return None, breaker.reason(host)
+    n = 0
+    while True:
+        threadstate.failure = None
+        try:
+            result = attempt()
+            error = None if result else threadstate.failure
+        except Exception as e:
+            result, error = None, e
+            if echo:
+                print(f"{r_}<ERROR> {dest[1] or dest[2]}: {str(e) or type(e).__name__}{_nc}")
+        if result:
+            breaker.success(host)
+            return result, None
+        # A permanent error (a wrong password, a missing directory) says nothing about whether the host is up
+        if not isTransient(error):
+            return result, error
+        breaker.failure(host)
+        n += 1
+        if n > args.retries or not breaker.allow(host):
+            return result, error
+        delay = retryDelay(n)
+        retryNote(dest, error, n, delay)
+        time.sleep(delay)
+
+# Pre-flight for serverlist runs (--no-preflight turns it off). All hostnames are resolved at once into dns_cache,
+# then one connection per host and user is opened and logged in to in parallel and left in its pool for the
+# transfers to pick up. Hosts that can't be resolved or reached are reported before anything is sent.
+preflight_workers = 32
+
+# Pooled connection a destination uses. SFTP and SCP share one SSH connection per host, user and password.
+def loginKey(dest):
+    return "ssh" if dest[0] in ("sftp", "scp", "ssh") else dest[0], dest[1], dest[3], passDigest(dest[4])
+
+# Open and log in to the pooled connection dest will use
+def warmLogin(dest):
+    protvar, servvar, _, uservar, passvar = dest
+    if protvar == "ftp":
+        ftppool.put(servvar, uservar, ftppool.get(servvar, uservar, passvar))
+    elif protvar == "smb":
+        smbpool.put(servvar, uservar, smbpool.get(servvar, uservar, passvar))
+    else:
+        sshpool.connect(servvar, uservar, passvar)
+    return True
+
+# Run the pre-flight for dests. Protocols in resolveonly (those the asyncio backend connects by itself) are only
+# resolved; destinations with the protocol "ssh" (commands, see sshFanout) get an SSH login whatever their
+# serverlist protocol. Returns {serverlist position: error} for the destinations to fail without running them.
+def preflight(dests, resolveonly=()):
+    if args.no_preflight:
+        return {}
+    start = time.monotonic()
+    hosts = sorted({dest[1] for dest in dests if dest[1]})
+    smbhosts = {dest[1] for dest in dests if dest[0] == "smb"}
+    logins = {}
+    for dest in dests:
+        if dest[0] not in resolveonly and dest[0] in ("ftp", "sftp", "scp", "smb", "ssh"):
+            logins.setdefault(loginKey(dest), dest)
+
+    def resolveWorker(servvar):
+        try:
+            resolveHost(servvar, None, socket.AF_INET if servvar in smbhosts else 0)
+            return servvar, None
+        except OSError as e:
+            return servvar, e
+
+    def loginWorker(item):
+        key, dest = item
+        threadstate.quiet = True
+        threadstate.noprompt = True
+        return key, retryCall(dest, lambda: warmLogin(dest), echo=False)[1]
+
+    unreachable = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(preflight_workers, len(hosts)))) as pool:
+        for servvar, e in pool.map(resolveWorker, hosts):
+            if e is not None:
+                unreachable[servvar] = e
+        # Only hosts that can't be reached are dropped. Login errors are left to the run, which may ask for a password
+        # and reports them if it still fails; e is a string when the circuit breaker gave up on the host.
+        todo = [(key, dest) for key, dest in logins.items() if key[1] not in unreachable]
+        ready = 0
+        failed = {}
+        for key, e in pool.map(loginWorker, todo):
+            if e is None:
+                ready += 1
+            elif isinstance(e, str) or isTransient(e):
+                failed[key] = e
+
+    readynote = f", {y_}{ready}{_nc} of {y_}{len(todo)}{_nc} logins ready" if todo else ""
+    print(f"Pre-flight: {y_}{len(hosts)}{_nc} hosts resolved{readynote} in {y_}{time.monotonic() - start:.1f}s{_nc}")
+    for servvar, e in sorted(unreachable.items()):
+        print(f"{r_}Unreachable:{_nc} {b_}{servvar}{_nc} {r_}{str(e) or type(e).__name__}{_nc}")
+    for key, e in sorted(failed.items()):
+        print(f"{r_}Unreachable:{_nc} {b_}{key[1]}{_nc} ({key[0].upper()}) {r_}{str(e) or type(e).__name__}{_nc}")
+    print(" ")
+
+    skip = {}
+    for i, dest in enumerate(dests):
+        e = unreachable.get(dest[1]) or failed.get(loginKey(dest))
+        if e is not None:
+            skip[i] = f"unreachable (pre-flight): {str(e) or type(e).__name__}"
+    return skip
+
+# asyncio SSH backend (--backend asyncio), on asyncssh. A fan-out's SFTP, SCP and exec sessions all run on one event
+# loop with one connection per destination, so each host costs a coroutine and a socket rather than an OS thread.
+
+# Parsed ~/.ssh/known_hosts, read once
+known_hosts = None
+
+# known_hosts for asyncssh.connect: hosts listed in ~/.ssh/known_hosts are verified against it, unknown hosts are
+# accepted like paramiko's WarningPolicy does for the default backend
+def asyncKnownHosts(servvar, port):
+    global known_hosts
+    import asyncssh
+
+    if known_hosts is None:
+        path = os.path.expanduser('~/.ssh/known_hosts')
+        known_hosts = asyncssh.read_known_hosts(path) if os.path.exists(path) else asyncssh.import_known_hosts('')
+    trusted = known_hosts.match(servvar, '', port)
+    return known_hosts if trusted[0] or trusted[1] else None
+
+# Open an SSH connection on the running event loop, timing DNS, connect and auth for the metrics like timedConnect.
+# SSH keys and agent are tried first, then the password if one is given.
+async def asyncConnect(servvar, uservar, passvar):
+    import asyncio
+    import asyncssh
+
+    loop = asyncio.get_running_loop()
+    port = sshpool.port
+    start = time.monotonic()
+    addrs = await asyncio.wait_for(loop.run_in_executor(None, resolveHost, servvar, port), args.connect_timeout)
+    resolved = time.monotonic()
+    # Every address in turn, as in timedConnect
+    for n, (family, socktype, proto, _, sockaddr) in enumerate(addrs):
+        attempt = time.monotonic()
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, sockaddr), args.connect_timeout)
+            break
+        except (OSError, asyncio.TimeoutError):
+            sock.close()
+            if n == len(addrs) - 1:
+                raise
+        except BaseException:
+            sock.close()
+            raise
+    connected = time.monotonic()
+    conn = await asyncio.wait_for(asyncssh.connect(servvar, port, sock=sock, username=uservar,
+                                                   password=passvar or None,
+                                                   known_hosts=asyncKnownHosts(servvar, port)), args.connect_timeout)
+    metrics.connected("ssh", servvar, resolved - start, connected - attempt, time.monotonic() - connected)
+    return conn
+
+# asyncssh progress handler, called with (source, destination, bytes copied so far, size) as each file goes out.
+# Feeds the progress line and times every file for the metrics.
+def asyncProgress(protvar, servvar):
+    files = {}
+
+    def handler(srcpath, dstpath, copied, total):
+        if srcpath not in files:
+            files[srcpath] = [metrics.start(protvar, servvar, srcpath.decode(errors='replace')), 0]
+        timer, last = files[srcpath]
+        progress.update(copied - last)
+        files[srcpath][1] = copied
+        if copied > 0:
+            timer.first()
+        if copied >= total:
+            timer.done(total)
+    return handler
+
+# Upload the selected files to one SFTP or SCP destination over conn. Returns True if every file was sent.
+async def asyncUpload(conn, dest, fileglob):
+    import asyncssh
+
+    protvar, servvar, remdirvar, uservar, _ = dest
+    destkey = destKey(protvar, servvar, uservar)
+    sendlist = []
+    for g in fileglob:
+        if os.path.isdir(g):
+            continue
+        if alreadySent(destkey, remdirvar + str(os.path.basename(g)), g):
+            continue
+        print(f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
+        sendlist.append(g)
+    if not sendlist:
+        return True
+
+    progress.begin(sum(os.path.getsize(g) for g in sendlist))
+    try:
+        if protvar == "scp":
+            await asyncssh.scp(sendlist, (conn, remdirvar or '.'), progress_handler=asyncProgress(protvar, servvar))
+        else:
+            async with conn.start_sftp_client() as sftpc:
+                await sftpc.put(sendlist, remdirvar or '.', progress_handler=asyncProgress(protvar, servvar))
+    finally:
+        progress.end()
+    for g in sendlist:
+        markSent(destkey, remdirvar + str(os.path.basename(g)), g)
+    return True
+
+# Upload a directory recursively to one SFTP or SCP destination over conn, into remdirvar (created if missing)
+async def asyncDirUpload(conn, dest, dirvar, remdirvar):
+    import shlex
+    import asyncssh
+
+    protvar, servvar = dest[0], dest[1]
+    dirvar = dirvar.replace('\\', '/').rstrip("/")
+    dirnum = 0
+    filenum = 0
+    dirbytes = 0
+    for walker in os.walk(dirvar):
+        dirnum += 1
+        filenum += len(walker[2])
+        dirbytes += sum(os.path.getsize(os.path.join(walker[0], file)) for file in walker[2])
+
+    print(f"Sending {g_}{dirvar}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
+    progress.begin(dirbytes)
+    try:
+        if protvar == "scp":
+            await conn.run(f"mkdir -p {shlex.quote(remdirvar)}", check=True)
+            await asyncssh.scp(dirvar, (conn, remdirvar), recurse=True, preserve=True,
+                               progress_handler=asyncProgress(protvar, servvar))
+        else:
+            async with conn.start_sftp_client() as sftpc:
+                await sftpc.makedirs(remdirvar, exist_ok=True)
+                await sftpc.put(dirvar, remdirvar, recurse=True, preserve=True,
+                                progress_handler=asyncProgress(protvar, servvar))
+    finally:
+        progress.end()
+    print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files to {b_}{servvar}{_nc} over {y_}{protvar.upper()}{_nc}.")
+    return True
+
+# Run a command over conn. Returns (exit code, stdout, stderr); the exit code is -1 if the command was killed.
+async def asyncExec(conn, dest, cmdvar):
+    result = await conn.run(cmdvar)
+    rc = result.exit_status if result.exit_status is not None else -1
+    return rc, result.stdout or "", result.stderr or ""
+
+# Run coro(conn, dest) for every destination on one event loop, workers (default --parallel) at a time, each over
+# its own connection. Returns a list of (dest, result, seconds, error) tuples in serverlist order. result is None if
+# the host could not be reached or the coroutine raised, with the reason in error. Failed connections are retried
+# as in retryCall; a failed coroutine only with rerun, as a command that already ran may not be safe to run twice.
+def asyncFanout(dests, coro, workers=None, rerun=True):
+    import asyncio
+    try:
+        import asyncssh
+    except ImportError:
+        print(f"{r_}<ERROR> --backend asyncio needs the asyncssh module{_nc} ({y_}pip install asyncssh{_nc})")
+        return [(dest, None, 0.0, "asyncssh not installed") for dest in dests]
+
+    async def destTask(limit, dest):
+        async with limit:
+            start = time.monotonic()
+            host = breakerKey(dest)
+            if not breaker.allow(host):
+                return dest, None, 0.0, breaker.reason(host)
+            n = 0
+            while True:
+                started = False
+                try:
+                    async with await asyncConnect(dest[1], dest[3], dest[4]) as conn:
+                        started = True
+                        result = await coro(conn, dest)
+                    breaker.success(host)
+                    return dest, result, time.monotonic() - start, ""
+                except Exception as e:
+                    error = e
+                if not isTransient(error):
+                    return dest, None, time.monotonic() - start, str(error) or type(error).__name__
+                breaker.failure(host)
+                n += 1
+                if n > args.retries or (started and not rerun) or not breaker.allow(host):
+                    return dest, None, time.monotonic() - start, str(error) or type(error).__name__
+                delay = retryDelay(n)
+                retryNote(dest, error, n, delay)
+                await asyncio.sleep(delay)
+
+    async def runAll():
+        limit = asyncio.Semaphore(max(1, workers or args.parallel))
+        return await asyncio.gather(*(destTask(limit, dest) for dest in dests))
+
+    # Output of the whole loop is one worker's as far as prompts and progress bars go
+    quiet = getattr(threadstate, 'quiet', False)
+    threadstate.quiet = quiet or (workers or args.parallel) > 1
+    try:
+        return asyncio.run(runAll())
+    finally:
+        threadstate.quiet = quiet
+
+# asyncfunc for mpfuFanout sending fileglob, or None when the asyncio backend isn't in use
+def asyncUploadFunc(fileglob):
+    return (lambda conn, dest: asyncUpload(conn, dest, fileglob)) if asyncBackend() else None
+
+# Whether the SSH destinations of a fan-out go to the asyncio backend. Options it doesn't have keep the run on paramiko.
+def asyncBackend(dirupload=False):
+    if args.backend != "asyncio":
+        return False
+    unsupported = [opt for opt, used in (('--fast', args.fast or fast_hosts), ('--resume', args.resume),
+                                         ('--streams', args.streams > 1))
+                   if used]
+    if dirupload:
+        unsupported += [opt for opt, used in (('--tar', args.tar), ('--sync', args.sync), ('--delete', args.delete))
+                        if used]
+    if unsupported:
+        print(f"{y_}{', '.join(unsupported)} need the paramiko backend; not using --backend asyncio for this run.{_nc}")
+        return False
+    return True
+
+# Rolling deploys (--canary, --wave). The serverlist is run in waves in order, each one in parallel, and the rollout
+# stops once the failure rate so far passes --max-fail. Destinations after that are reported with rollout_stopped.
+rollout_stopped = "skipped, rollout stopped"
+
+def wavesOn():
+    return bool(args.canary or args.wave)
+
+# Hosts in a batch from parseBatch, out of total
+def batchCount(batch, total):
+    number, percent = batch
+    return max(1, int(-(-total * number // 100)) if percent else int(number))
+
+# Serverlist positions of each wave: the canary batch, then --wave sized waves. One wave of everything otherwise.
+def planWaves(total):
+    positions = list(range(total))
+    if not wavesOn():
+        return [positions]
+    waves = []
+    if args.canary:
+        count = batchCount(args.canary, total)
+        waves.append(positions[:count])
+        positions = positions[count:]
+    size = batchCount(args.wave, total) if args.wave else len(positions)
+    while positions:
+        waves.append(positions[:size])
+        positions = positions[size:]
+    return [wave for wave in waves if wave]
+
+# Call runwave(positions, workers) for each wave of dests; runwave returns how many of its destinations failed.
+# Returns the positions that were never run because the rollout stopped.
+def rollout(dests, runwave):
+    waves = planWaves(len(dests))
+    if len(waves) == 1:
+        runwave(waves[0], max(1, args.parallel))
+        return []
+
+    done = failed = 0
+    for n, wave in enumerate(waves):
+        if n and args.wave_pause > 0:
+            print(f"Next wave in {y_}{args.wave_pause:g}s{_nc} (Ctrl-C to stop the rollout)...")
+            try:
+                time.sleep(args.wave_pause)
+            except KeyboardInterrupt:
+                print(f"\n{r_}Rollout stopped{_nc} before wave {n + 1} of {len(waves)}.\n")
+                return [i for w in waves[n:] for i in w]
+        workers = args.parallel if args.parallel > 1 else len(wave)
+        label = " (canary)" if n == 0 and args.canary else ""
+        print(f"\n{bld_}Wave {n + 1}/{len(waves)}{label}{_nc}: {y_}{len(wave)}{_nc} destinations, {y_}{min(workers, len(wave))}{_nc} at a time =>\n")
+        failed += runwave(wave, workers)
+        done += len(wave)
+        if failed * 100 > args.max_fail * done and n < len(waves) - 1:
+            rest = [i for w in waves[n + 1:] for i in w]
+            print(f"\n{r_}Rollout stopped{_nc}: {failed} of {done} destinations failed ({failed * 100 / done:.0f}%, "
+                  f"over --max-fail {args.max_fail:g}%). {y_}{len(rest)}{_nc} destinations not run.\n")
+            return rest
+    return []
+
+# Run destfunc(dest) for every destination, --parallel at a time (or in waves, see rollout), and print a result
+# table at the end. destfunc returns True on success. With --backend asyncio, SFTP and SCP destinations run
+# asyncfunc(conn, dest) on one event loop instead, alongside the threads working through the rest.
+# Returns a list of (dest, ok, seconds, error) tuples in serverlist order.
+def mpfuFanout(dests, destfunc, asyncfunc=None):
+    results = [None] * len(dests)
+
+    def fanWorker(dest, quiet):
+        threadstate.quiet = quiet
+        threadstate.noprompt = True
+        start = time.monotonic()
+        ok, error = retryCall(dest, lambda: destfunc(dest))
+        if ok:
+            err = ""
+        elif error is None:
+            err = "failed (see output above)"
+        else:
+            err = str(error) or type(error).__name__
+        return dest, bool(ok), time.monotonic() - start, err
+
+    def runWave(positions, workers):
+        for i in positions:
+            if i in skip:
+                results[i] = (dests[i], False, 0.0, skip[i])
+        # SFTP and SCP destinations for the event loop, the rest for the threads
+        aslots = [i for i in positions if i not in skip and asyncfunc and dests[i][0] in ("sftp", "scp")]
+        tslots = sorted(set(positions) - set(aslots) - set(skip))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            threaded = pool.map(lambda dest: fanWorker(dest, workers > 1), [dests[i] for i in tslots])
+            for i, (dest, ok, secs, err) in zip(aslots, asyncFanout([dests[i] for i in aslots], asyncfunc, workers) if aslots else []):
+                if ok is None:
+                    print(f"{r_}<ERROR> {dest[1]}: {err}{_nc}")
+                elif not ok:
+                    err = "failed (see output above)"
+                results[i] = (dest, bool(ok), secs, err)
+            for i, result in zip(tslots, threaded):
+                results[i] = result
+        return len([i for i in positions if not results[i][1]])
+
+    start = time.monotonic()
+    skip = preflight(dests, ("sftp", "scp") if asyncfunc else ())
+    if args.parallel > 1 and not wavesOn():
+        print(f"Running on {y_}{len(dests)}{_nc} destinations, {y_}{args.parallel}{_nc} at a time =>\n")
+    for i in rollout(dests, runWave):
+        results[i] = (dests[i], False, 0.0, rollout_stopped)
+    resultTable(results, time.monotonic() - start)
+    metrics.report()
+    return results
+
+# Print per-destination outcome of a fan-out run
+def resultTable(results, elapsed):
+    rows = []
+    for dest, ok, secs, err in results:
+        protvar, servvar, remdirvar = dest[0], dest[1], dest[2]
+        target = f"s3://{remdirvar}" if protvar == "s3" else f"{servvar}:{remdirvar}"
+        rows.append((target, protvar.upper(), ok, f"{secs:.1f}s", err))
+    width = max([len(r[0]) for r in rows] + [11])
+
+    print(f"\n{bld_}{'Destination'.ljust(width)}  {'Proto'.ljust(5)}  {'Result'.ljust(7)}  {'Time'.rjust(8)}{_nc}")
+    for target, prot, ok, secs, err in rows:
+        if ok:
+            status = f"{g_}{'OK'.ljust(7)}{_nc}"
+        elif err == rollout_stopped:
+            status = f"{y_}{'SKIPPED'.ljust(7)}{_nc}"
+        else:
+            status = f"{r_}{'FAILED'.ljust(7)}{_nc}"
+        line = f"{target.ljust(width)}  {prot.ljust(5)}  {status}  {secs.rjust(8)}"
+        if err and err != rollout_stopped:
+            line += f"  {r_}{err}{_nc}"
+        print(line)
+    skipped = len([r for r in rows if r[4] == rollout_stopped])
+    failed = len([r for r in rows if not r[2]]) - skipped
+    notrun = f", {y_}{skipped}{_nc} not run" if skipped else ""
+    print(f"\n{y_}{len(rows) - failed - skipped}{_nc} succeeded, {r_ if failed else y_}{failed}{_nc} failed{notrun} in {y_}{elapsed:.1f}s{_nc}\n")
 
 # MPFU multi-file upload function
 def mpfuMultiUpload():
@@ -754,54 +2643,11 @@ Enter server list in the format above:""")
 
     dirvar, filevar, fileglob = localfsPrompt()
 
-    # Loop through input list and parse into variables
-    split_input = inputlistvar.split(",")
-    for e in range(len(split_input)):
-        pop_input = split_input.pop()
-        elem = pop_input.split(":")
-        protvar = elem[0].strip()
-        if protvar != "s3":
-            servvar = elem[1].strip()
-            remdirvar = elem[2].strip()
-            uservar = elem[3].strip()
-            passvar = elem[4].strip()
-        if protvar == "s3":
-            remdirvar = elem[1].strip()
-
-        # Perform uploads
-        if protvar == "ftp":
-            print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-            ftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob)
-        elif protvar == "sftp":
-            pssh=paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(
-                paramiko.WarningPolicy())
-            print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                        timeout=8)
-            sftpc=pssh.open_sftp()
-            sftpUpload(protvar, servvar, uservar, passvar,
-                        dirvar, filevar, remdirvar, fileglob, sftpc)
-        elif protvar == "scp":
-            import scp
-            pssh=paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                         timeout=8)
-            pscp=scp.SCPClient(pssh.get_transport(), progress=sbar)
-            print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-            scpUpload(protvar, servvar, uservar, passvar,
-                      dirvar, filevar, remdirvar, fileglob, pscp)
-        elif protvar == "smb":
-            print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-            smbUpload(protvar, servvar, uservar, passvar,
-                      dirvar, filevar, remdirvar, fileglob)
-        if protvar == "s3":
-            print(f"Starting transfers to {y_}s3://{_nc}:{p_}{remdirvar}{_nc}: \n")
-            servvar, uservar, passvar = (" ", " ", " ")
-            s3Upload(dirvar, filevar, fileglob, remdirvar)
+    fast_hosts.clear()
+    dests = parseDests(inputlistvar.split(","))
+    relay = s3Relay(dests)
+    mpfuFanout(dests, lambda dest: uploadDest(dest, dirvar, filevar, fileglob, relay),
+               asyncUploadFunc(fileglob))
 
 # MPFU multi-file upload to destination list file
 def mpfuMultiUploadFile():
@@ -822,66 +2668,392 @@ AWS S3:
         print(" ")
         return
     elif args.list:
-        with open(args.list, 'r') as serv_file:
-            ufile_input = serv_file.read()
-            sfile_input = ufile_input.strip()
-
-            dirvar, filevar, fileglob = localfsPrompt()
-
-            # Loop through input list and parse into variables
-            split_input = sfile_input.split("\n")
-            for e in range(len(split_input)):
-                pop_input = split_input.pop()
-                elem = pop_input.split(":")
-                protvar = elem[0].strip()
-                if protvar != "s3":
-                    servvar = elem[1].strip()
-                    remdirvar = elem[2].strip()
-                    uservar = elem[3].strip()
-                    passvar = elem[4].strip()
-                if protvar == "s3":
-                    remdirvar = elem[1].strip()
-                    servvar = ""
-                    uservar = ""
-                    passvar = ""
-
-                # Perform uploads
-                if protvar == "ftp":
-                    print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-                    ftpUpload(protvar, servvar, uservar, passvar,
-                            dirvar, filevar, remdirvar, fileglob)
-                elif protvar == "sftp":
-                    pssh = paramiko.SSHClient()
-                    pssh.load_system_host_keys()
-                    pssh.set_missing_host_key_policy(
-                        paramiko.WarningPolicy())
-                    print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-                    pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                                timeout=8)
-                    sftpc = pssh.open_sftp()
-                    sftpUpload(protvar, servvar, uservar, passvar,
-                            dirvar, filevar, remdirvar, fileglob, sftpc)
-                elif protvar == "scp":
-                    import scp
-                    pssh = paramiko.SSHClient()
-                    pssh.load_system_host_keys()
-                    pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-                    pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                                timeout=8)
-                    pscp = scp.SCPClient(pssh.get_transport(), progress=sbar)
-                    print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-                    scpUpload(protvar, servvar, uservar, passvar,
-                            dirvar, filevar, remdirvar, fileglob, pscp)
-                elif protvar == "smb":
-                    print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-                    smbUpload(protvar, servvar, uservar, passvar,
-                            dirvar, filevar, remdirvar, fileglob)
-                if protvar == "s3":
-                    print(
-                        f"Starting transfers to {y_}s3://{_nc}:{p_}{remdirvar}{_nc}: \n")
-                    servvar, uservar, passvar = (" ", " ", " ")
-                    s3Upload(dirvar, filevar, fileglob, remdirvar)
+        dests = listDests()
+        dirvar, filevar, fileglob = localfsPrompt()
 
+        relay = s3Relay(dests)
+        mpfuFanout(dests, lambda dest: uploadDest(dest, dirvar, filevar, fileglob, relay),
+                   asyncUploadFunc(fileglob))
+
+
+# Recursively remove a remote directory over SFTP
+def sftpRmtree(sftpc, rempath):
+    for attr in sftpc.listdir_attr(rempath):
+        child = rempath + '/' + attr.filename
+        if stat.S_ISDIR(attr.st_mode):
+            sftpRmtree(sftpc, child)
+        else:
+            sftpc.remove(child)
+    sftpc.rmdir(rempath)
+
+# Shell loop run on the remote host by execMkdirs: print the dirs that already exist, create the rest with parents
+mkdir_script = 'for d; do if [ -d "$d" ]; then echo "$d"; else mkdir -p -- "$d" || exit 1; fi; done'
+
+# Create remote dirs with as few exec round trips as possible, batching arguments to stay well under ARG_MAX.
+# Returns the set of dirs that already existed.
+def execMkdirs(transport, remdirs):
+    import shlex
+
+    existing = set()
+    batch, batchlen = [], 0
+    for remdir in remdirs + [None]:
+        if remdir is not None and batchlen + len(remdir) < 65536:
+            batch.append(shlex.quote(remdir))
+            batchlen += len(batch[-1]) + 1
+            continue
+        if batch:
+            chan = transport.open_session()
+            chan.exec_command(f"sh -c {shlex.quote(mkdir_script)} sh {' '.join(batch)}")
+            stdout = chan.makefile('rb').read().decode(errors='replace')
+            stderr = chan.makefile_stderr('rb').read().decode(errors='replace').strip()
+            rc = chan.recv_exit_status()
+            chan.close()
+            if rc != 0:
+                raise IOError(f"remote mkdir exited with code {rc}: {stderr}")
+            existing.update(stdout.splitlines())
+        if remdir is not None:
+            batch, batchlen = [shlex.quote(remdir)], len(remdir) + 1
+    return existing
+
+# Create remote dirs over SFTP one request at a time, stat-ing the ones that fail to tell existing dirs from real
+# failures. Only used when the host refuses exec, so the per-dir round trips are the price of SFTP-only accounts.
+# Dirs must be ordered parents first. Returns the set of dirs that already existed.
+def sftpMkdirs(sftpc, remdirs):
+    existing = set()
+    for remdir in remdirs:
+        try:
+            sftpc.mkdir(remdir)
+            continue
+        except IOError:
+            pass
+        try:
+            if stat.S_ISDIR(sftpc.stat(remdir).st_mode or 0):
+                existing.add(remdir)
+                continue
+        except IOError:
+            pass
+        if not isQuiet():
+            print(f"{r_}Can't create dir{_nc} {p_}{remdir}{_nc}{r_}; bad permissions or a file is in the way{_nc}")
+    return existing
+
+# Tree-creation stage of a directory upload: create every remote dir before any file is sent, using a single shell
+# command where the host allows exec and plain SFTP requests where it doesn't (SFTP-only accounts, Windows).
+# Returns the set of dirs that already existed.
+def remoteMkdirs(sftpc, remdirs):
+    try:
+        return execMkdirs(sftpc.get_channel().get_transport(), remdirs)
+    except (paramiko.ssh_exception.SSHException, IOError, EOFError):
+        # SFTP has no mkdir -p, so the upload root's parents are created (or found) first
+        parents = []
+        parent = os.path.dirname(remdirs[0])
+        while parent not in ("", "/", "."):
+            parents.insert(0, parent)
+            parent = os.path.dirname(parent)
+        return sftpMkdirs(sftpc, parents + remdirs)
+
+# Recursively upload local directory dirvar into remdirvar over an open SFTP client. All remote dirs are created
+# up front by remoteMkdirs, then files are sent.
+# With --sync, each existing remote directory is listed once and only new or changed files (by size and mtime) are sent.
+# With --delete, remote entries missing locally are removed as well.
+def dirUpload(protvar, servvar, dirvar, remdirvar, sftpc):
+    term_width = shutil.get_terminal_size()[0]
+    dirvar = dirvar.replace('\\', '/').rstrip("/")
+    base = os.path.split(dirvar)[0] or os.curdir
+    sync = args.sync or args.delete
+    filenum = 0
+    skipnum = 0
+    delnum = 0
+
+    walk = [(os.path.normpath(os.path.join(remdirvar, os.path.relpath(walker[0], base))).replace('\\', '/'), walker)
+            for walker in os.walk(dirvar)]
+    remdirs = [remdir for remdir, _ in walk]
+    if not isQuiet():
+        print(f"Creating {y_}{len(remdirs)}{_nc} remote directories under {p_}{remdirvar}{_nc} =>")
+    existing = remoteMkdirs(sftpc, remdirs)
+    dirnum = len([remdir for remdir in remdirs if remdir not in existing])
+
+    if not isQuiet():
+        showCursor(False)
+    for remdir_create, walker in walk:
+        # Only dirs that were already there can hold files to skip or delete
+        remote_attrs = {}
+        if sync and remdir_create in existing:
+            remote_attrs = {a.filename: a for a in sftpc.listdir_attr(remdir_create)}
+
+        for file in walker[2]:
+            localfile = os.path.join(walker[0], file)
+            remfile = remdir_create + '/' + file
+            if sync:
+                local_st = os.stat(localfile)
+                rem_st = remote_attrs.get(file)
+                if rem_st is not None and not stat.S_ISDIR(rem_st.st_mode or 0) \
+                        and rem_st.st_size == local_st.st_size and int(rem_st.st_mtime) == int(local_st.st_mtime):
+                    skipnum += 1
+                    continue
+            if not isQuiet():
+                transferprog = f"Transferring: {g_}{file}{_nc}"
+                print(transferprog + " " * (term_width
+                                            - len(transferprog) - 1), end="\r")
+            timer = metrics.start(protvar.lower(), servvar, localfile)
+            sftpPut(sftpc, servvar, localfile, remfile)
+            timer.done(os.path.getsize(localfile))
+            # Carry the local mtime over so the next sync run sees the file as unchanged
+            if sync:
+                sftpc.utime(remfile, (int(local_st.st_atime), int(local_st.st_mtime)))
+            filenum += 1
+
+        if args.delete:
+            localnames = set(walker[1]) | set(walker[2])
+            for name, rem_st in remote_attrs.items():
+                if name in localnames:
+                    continue
+                if not isQuiet():
+                    print(f"Deleting remote orphan {p_}{remdir_create}/{name}{_nc}")
+                if stat.S_ISDIR(rem_st.st_mode or 0):
+                    sftpRmtree(sftpc, remdir_create + '/' + name)
+                else:
+                    sftpc.remove(remdir_create + '/' + name)
+                delnum += 1
+
+    if not isQuiet():
+        showCursor(True)
+    sftpc.close()
+    print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files to {b_}{servvar}{_nc} over {y_}{protvar}{_nc}.")
+    if sync:
+        print(f"Skipped {y_}{skipnum}{_nc} unchanged files, deleted {y_}{delnum}{_nc} remote orphans.")
+    return True
+
+# Upload local directory dirvar into remdirvar as one tar stream over an SSH exec channel. The archive is built
+# on the fly while it is sent, so no temporary file is needed and the remote side unpacks as data arrives.
+def tarUpload(protvar, servvar, uservar, passvar, dirvar, remdirvar):
+    import tarfile
+    import shlex
+    import types
+
+    dirvar = dirvar.replace('\\', '/').rstrip("/")
+    compress = args.compress or ''
+    tarflag = {'': '', 'gz': 'z', 'bz2': 'j', 'xz': 'J'}[compress]
+    remdir_q = shlex.quote(remdirvar)
+    dirnum = 0
+    filenum = 0
+    tarbytes = 0
+
+    def countMember(tarinfo):
+        nonlocal dirnum, filenum, tarbytes
+        if tarinfo.isdir():
+            dirnum += 1
+        else:
+            filenum += 1
+            tarbytes += tarinfo.size
+        return tarinfo
+
+    # The progress line follows file contents as tarfile reads them, since the stream itself is larger (headers)
+    # or smaller (compression) than the files
+    class progressTar(tarfile.TarFile):
+
+        def addfile(self, tarinfo, fileobj=None):
+            if fileobj is not None:
+                read = fileobj.read
+
+                def countedRead(size=-1):
+                    data = read(size)
+                    progress.update(len(data))
+                    return data
+                fileobj = types.SimpleNamespace(read=countedRead)
+            super().addfile(tarinfo, fileobj)
+
+    dirbytes = 0
+    for walker in os.walk(dirvar):
+        for file in walker[2]:
+            st = os.lstat(os.path.join(walker[0], file))
+            if stat.S_ISREG(st.st_mode):
+                dirbytes += st.st_size
+
+    # tarfile buffers bufsize bytes itself, so its writes go straight to the channel
+    def sendStream(data):
+        timer.first()
+        chan.sendall(data)
+
+    print(f"Streaming {g_}{dirvar}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} as {y_}tar{'.' + compress if compress else ''}{_nc} over {y_}{protvar}{_nc} =>")
+    chan = sshpool.connect(servvar, uservar, passvar).get_transport().open_session()
+    timer = metrics.start(protvar.lower(), servvar, dirvar)
+    chan.exec_command(f"mkdir -p {remdir_q} && tar x{tarflag}f - -C {remdir_q}")
+    # If mkdir or tar exits early (a file in the way, no permission) the channel closes under the writer; the exit
+    # code and stderr say why, so they are read before giving up on the write error.
+    writeerror = None
+    progress.begin(dirbytes)
+    try:
+        with progressTar.open(fileobj=types.SimpleNamespace(write=sendStream), mode='w|' + compress,
+                              bufsize=262144) as tar:
+            tar.add(dirvar, arcname=os.path.basename(dirvar), filter=countMember)
+        chan.shutdown_write()
+    except OSError as e:
+        writeerror = e
+    finally:
+        progress.end()
+
+    rc = chan.recv_exit_status()
+    stderr = chan.makefile_stderr('rb').read().decode(errors='replace').strip()
+    chan.close()
+    if rc != 0:
+        print(f"{r_}<ERROR> Remote tar on {servvar} exited with code {rc}{_nc}: {stderr}")
+        transferFailed(IOError(f"remote tar exited with code {rc}: {stderr}"))
+        return False
+    if writeerror is not None:
+        raise writeerror
+    timer.done(tarbytes)
+    print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files to {b_}{servvar}{_nc} over {y_}{protvar}{_nc}.")
+    return True
+
+# Recursively remove a directory on an SMB share
+def smbRmtree(smbc, share_n, rempath):
+    for entry in smbc.listPath(share_n, rempath):
+        if entry.filename in ('.', '..'):
+            continue
+        if entry.isDirectory:
+            smbRmtree(smbc, share_n, rempath + '/' + entry.filename)
+        else:
+            smbc.deleteFiles(share_n, rempath + '/' + entry.filename)
+    smbc.deleteDirectory(share_n, rempath)
+
+# Recursively upload local directory dirvar into remdirvar (/share/path/) on an SMB server. The remote tree is
+# created first, then files are stored over several pooled connections at once (see smbStore).
+# With --sync, files whose size matches and whose remote copy is at least as new as the local file are skipped.
+# With --delete, remote entries missing locally are removed as well.
+def smbDirUpload(protvar, servvar, uservar, passvar, dirvar, remdirvar):
+    from smb.smb_structs import OperationFailure
+
+    term_width = shutil.get_terminal_size()[0]
+    dirvar = dirvar.replace('\\', '/').rstrip("/")
+    base = os.path.split(dirvar)[0] or os.curdir
+    share_n, path_n = smbPath(remdirvar)
+    sync = args.sync or args.delete
+    skipnum = 0
+    delnum = 0
+    filenum = 0
+
+    walk = [(os.path.normpath(os.path.join(path_n, os.path.relpath(walker[0], base))).replace('\\', '/'), walker)
+            for walker in os.walk(dirvar)]
+
+    # Parents of the target path first, then the tree itself, parents before children
+    remdirs = []
+    for part in path_n.strip('/').split('/'):
+        if part:
+            remdirs.append((remdirs[-1] if remdirs else '') + '/' + part)
+    remdirs += [remdir for remdir, _ in walk]
+
+    if not isQuiet():
+        print(f"Creating {y_}{len(walk)}{_nc} remote directories under {p_}{remdirvar}{_nc} =>")
+    smbc = smbpool.get(servvar, uservar, passvar)
+    existing = set()
+    jobs = []
+    try:
+        for remdir in remdirs:
+            try:
+                smbc.createDirectory(share_n, remdir)
+            except OperationFailure:
+                if not smbc.getAttributes(share_n, remdir).isDirectory:
+                    raise
+                existing.add(remdir)
+
+        for remdir, walker in walk:
+            # Only dirs that were already there can hold files to skip or delete
+            remote_attrs = {}
+            if sync and remdir in existing:
+                remote_attrs = {a.filename: a for a in smbc.listPath(share_n, remdir)
+                                if a.filename not in ('.', '..')}
+
+            for file in walker[2]:
+                localfile = os.path.join(walker[0], file)
+                if sync:
+                    local_st = os.stat(localfile)
+                    rem_st = remote_attrs.get(file)
+                    if rem_st is not None and not rem_st.isDirectory and rem_st.file_size == local_st.st_size \
+                            and int(rem_st.last_write_time) >= int(local_st.st_mtime):
+                        skipnum += 1
+                        continue
+                jobs.append((localfile, remdir + '/' + file))
+
+            if args.delete:
+                localnames = set(walker[1]) | set(walker[2])
+                for name, rem_st in remote_attrs.items():
+                    if name in localnames:
+                        continue
+                    if not isQuiet():
+                        print(f"Deleting remote orphan {p_}{remdir}/{name}{_nc}")
+                    if rem_st.isDirectory:
+                        smbRmtree(smbc, share_n, remdir + '/' + name)
+                    else:
+                        smbc.deleteFiles(share_n, remdir + '/' + name)
+                    delnum += 1
+    except BaseException:
+        smbpool.discard(smbc)
+        raise
+    smbpool.put(servvar, uservar, smbc)
+
+    # Runs in smbStore's worker threads, which don't carry this thread's quiet flag
+    quiet = isQuiet()
+    donelock = threading.Lock()
+
+    def smbDone(localfile, rempath):
+        nonlocal filenum
+        with donelock:
+            filenum += 1
+        if not quiet:
+            transferprog = f"Transferring: {g_}{os.path.basename(localfile)}{_nc}"
+            print(transferprog + " " * (term_width
+                                        - len(transferprog) - 1), end="\r")
+
+    if jobs:
+        smbStore(servvar, uservar, passvar, share_n, jobs, smbDone)
+    dirnum = len([remdir for remdir, _ in walk if remdir not in existing])
+    print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files to {b_}{servvar}{_nc} over {y_}{protvar}{_nc}.")
+    if sync:
+        print(f"Skipped {y_}{skipnum}{_nc} unchanged files, deleted {y_}{delnum}{_nc} remote orphans.")
+    return True
+
+# Recursively upload local directory dirvar into remdirvar with a single recursive SCP invocation, for hosts
+# without the SFTP subsystem. Modification times are preserved. --sync and --delete need SFTP and are not applied.
+def scpDirUpload(protvar, servvar, uservar, passvar, dirvar, remdirvar):
+    dirvar = dirvar.replace('\\', '/').rstrip("/")
+    dirnum = 0
+    filenum = 0
+    dirbytes = 0
+    for walker in os.walk(dirvar):
+        dirnum += 1
+        filenum += len(walker[2])
+        dirbytes += sum(os.path.getsize(os.path.join(walker[0], file)) for file in walker[2])
+
+    if (args.sync or args.delete) and not isQuiet():
+        print(f"{y_}--sync and --delete need SFTP; sending the whole directory over SCP.{_nc}")
+    print(f"Sending {g_}{dirvar}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar}{_nc} =>")
+    # scp copies into remdirvar only if it already exists, so create it (and its parents) first
+    execMkdirs(sshpool.connect(servvar, uservar, passvar).get_transport(), [remdirvar])
+    pscp = sshpool.scp(servvar, uservar, passvar)
+    progress.begin(dirbytes)
+    threadstate.scp_host = (protvar.lower(), servvar)
+    try:
+        pscp.put(dirvar, remote_path=remdirvar, recursive=True, preserve_times=True)
+    finally:
+        threadstate.scp_host = None
+        progress.end()
+    pscp.close()
+    if not isQuiet():
+        print("\n")
+    print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files to {b_}{servvar}{_nc} over {y_}{protvar}{_nc}.")
+    return True
+
+# Upload a directory to a serverlist destination over its pooled connection
+def dirUploadDest(dest, dirvar, remdirvar):
+    protvar, servvar, _, uservar, passvar = dest
+    print(f"\nStarting directory transfer to {b_}{servvar}{_nc}: ")
+    if protvar == "smb":
+        return smbDirUpload(protvar.upper(), servvar, uservar, passvar, dirvar, remdirvar)
+    if args.tar:
+        return tarUpload(protvar.upper(), servvar, uservar, passvar, dirvar, remdirvar)
+    if protvar == "scp":
+        return scpDirUpload(protvar.upper(), servvar, uservar, passvar, dirvar, remdirvar)
+    return dirUpload(protvar.upper(), servvar, dirvar, remdirvar, sshpool.sftp(servvar, uservar, passvar))
 
 def mpfuDirUpload():
     # If serverlist file NOT supplied as CLI argument
@@ -892,76 +3064,66 @@ Serverlist not provided at CLI. Defaulting to {y_}single machine{_nc} directory
 If you wish to upload to multiple machines, provide a serverlist when running {bld_}MPFU{_nc}:
 {y_}mpfu -l serverlist.txt{_nc}
         """)
-        print(f"\nCurrently only {y_}SFTP{_nc} (and therefore Linux systems) are supported for this function.\n")
+        print(f"""
+Directories can be uploaded over {y_}SFTP{_nc} or {y_}SCP{_nc} (Linux systems) or {y_}CIFS/SMB{_nc} (Windows File Shares).
+
+Choose destination type:
+
+1) SFTP
+2) CIFS/SMB (Windows File Share)
+3) SCP (for hosts without SFTP)""")
+        protchoice = input("\nEnter protocol [1-3]: ").strip()
+        if protchoice == "2":
+            smbprompt = f"\nEnter server and share for upload (e.g. {p_}\\\\fileserver.name.net\\network\\share\\{_nc}): "
+            smb_info = input(smbprompt).replace(
+                '\\\\', '/').replace('\\', '/').split('/')
+            servvar = smb_info[1]
+            remdirvar = '/' + '/'.join(smb_info[2:])
+            uservar, passvar = credPrompt()
+            readline.set_completer(t.pathCompleter)
+            dirvar = input("\nLocal directory to upload (include leading slash): ")
+            print(" ")
+            try:
+                smbDirUpload("SMB", servvar, uservar, passvar, dirvar, remdirvar)
+            except (socket.gaierror, socket.timeout):
+                print(f"""
+    {r_}<ERROR>
+    Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
+                input("Press a key to continue...")
+                print(" ")
+            except Exception as e:
+                print(f"""
+    {r_}<ERROR>
+    The server raised an exception: {e} {_nc}\n""")
+                input("Press a key to continue...")
+                print(" ")
+            return
+
         servvar = servPrompt()
         uservar = input("\nUsername: ")
-        passvar = ""
-        
-        term_width, term_height = os.get_terminal_size()
-        try:
-            pssh = paramiko.SSHClient()
-            pssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            pssh.connect(hostname=servvar, username=uservar,
-                         timeout=8)
-            sftpc = pssh.open_sftp()
 
-        except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-            print(
-               f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
-            passvar = getpass.getpass('')
+        protvar = "SCP" if protchoice == "3" else "SFTP"
+        if protvar == "SCP":
+            sftpc = None
+            sshpool.connect(servvar, uservar)
+        else:
+            sftpc = sshpool.sftp(servvar, uservar)
 
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                        timeout=8)
-            sftpc = pssh.open_sftp()
-        
         remdirvar = input(
             "\nRemote directory on server to upload local directory (if nonexistent, it will be created): ")
         readline.set_completer(t.pathCompleter)
         dirvar = input("\nLocal directory to upload (include leading slash): ")
         print(" ")
-        protvar = "SFTP"
 
         try:
-            dirvar = dirvar.replace('\\', '/').rstrip("/")
-            os.chdir(os.path.split(dirvar)[0])
-            parent = os.path.split(dirvar)[1]
-            dirnum = 0
-            filenum = 0
-
-            if plat_type == 'Linux':
-                os.system('setterm -cursor off')
-            for walker in os.walk(parent):
-                try:
-                    remdir_create = os.path.normpath(os.path.join(
-                        remdirvar, walker[0])).replace('\\', '/')
-                    pretty_remdir = (
-                        remdir_create[:20] + "..." + remdir_create[-35:]) if len(remdir_create) > term_width - 15 else remdir_create
-                    remdir_creation = f"Creating {p_}{pretty_remdir}{_nc}=>"
-                    print(remdir_creation + " "
-                          * (term_width - len(remdir_creation) - 1))
-                    sftpc.mkdir(os.path.normpath(os.path.join(
-                        remdirvar, walker[0])).replace('\\', '/'))
-                    dirnum += 1
-                except Exception as e:
-                    print(f"{r_}Can't create dir{_nc} {p_}{pretty_remdir}{_nc}{r_}; already exists or bad permissions{_nc}")
-                    print("")
-
-                for file in walker[2]:
-                    print(f"Transferring: {g_}{file}{_nc}", end="\r")
-                    transferprog = f"Transferring: {g_}{file}{_nc}"
-                    print(transferprog + " " * (term_width
-                                                - len(transferprog) - 1), end="\r")
-                    sftpc.put(os.path.normpath(os.path.join(walker[0], file)).replace(
-                        '\\', '/'), os.path.join(remdirvar, walker[0], file).replace('\\', '/'))
-                    filenum += 1
-
-            if plat_type == 'Linux':
-                os.system('setterm -cursor on')
-            sftpc.close()
-            print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files.")
+            if args.tar:
+                if sftpc:
+                    sftpc.close()
+                tarUpload(protvar, servvar, uservar, None, dirvar, remdirvar)
+            elif protvar == "SCP":
+                scpDirUpload(protvar, servvar, uservar, None, dirvar, remdirvar)
+            else:
+                dirUpload(protvar, servvar, dirvar, remdirvar, sftpc)
 
         except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType):
             print(f"""
@@ -977,127 +3139,112 @@ If you wish to upload to multiple machines, provide a serverlist when running {b
             input("Press a key to continue...")
             print(" ")
             return
+        except Exception as e:
+            print(f"""
+    {r_}<ERROR>
+    The server raised an exception: {e} {_nc}\n""")
+            input("Press a key to continue...")
+            print(" ")
+            return
 
     elif args.list:
         print(
             f"""
-Currently only {y_}SFTP{_nc} (and therefore Linux systems) are supported for this function. Other protocols and
-systems from the list will be ignored.""")
-        
+Directories are uploaded to the {y_}SFTP{_nc}, {y_}SCP{_nc} and {y_}CIFS/SMB{_nc} destinations in the list. Other protocols
+from the list will be ignored.""")
+        dests = [d for d in listDests() if d[0] in ("sftp", "scp", "smb")]
+
         remdirvar = input(
             "\nRemote directory on servers to upload local directory (if nonexistent, it will be created): ")
         readline.set_completer(t.pathCompleter)
         dirvar = input("\nLocal directory to upload (include leading slash): ")
         print(" ")
-        term_width, term_height = os.get_terminal_size()
-
-        with open(args.list, 'r') as serv_file:
-            ufile_input = serv_file.read()
-            sfile_input = ufile_input.strip()
-
-            # Loop through input list and parse into variables
-            split_input = sfile_input.split("\n")
-            for e in range(len(split_input)):
-                pop_input = split_input.pop()
-                elem = pop_input.split(":")
-                protvar = elem[0]
-                if protvar == "sftp":
-                    servvar = elem[1].strip()
-                    uservar = elem[3].strip()
-                    passvar = elem[4].strip()
-                else:
-                    continue
-                try:
-                    pssh = paramiko.SSHClient()
-                    pssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    pssh.connect(hostname=servvar, username=uservar,
-                                timeout=8)
-                    sftpc = pssh.open_sftp()
-                except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-                    print(
-                        f"\n{r_}No SSH key matching this host to authenticate with.{_nc}\n")
-                    print(f"Enter password for {y_}{uservar}{_nc}: ")
-
-                    passvar = getpass.getpass('')
-
-                    pssh = paramiko.SSHClient()
-                    pssh.load_system_host_keys()
-                    pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-                    pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                                timeout=8)
-                    sftpc = pssh.open_sftp()
-                try:
-                    print(f"\nStarting directory transfer to {b_}{servvar}{_nc}: ")
-                    pssh = paramiko.SSHClient()
-                    pssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    pssh.connect(hostname=servvar, username=uservar,
-                                 password=passvar, timeout=8)
-                    sftpc = pssh.open_sftp()
-
-                    dirvar = dirvar.replace('\\', '/').rstrip("/")
-                    os.chdir(os.path.split(dirvar)[0])
-                    parent = os.path.split(dirvar)[1]
-                    dirnum = 0
-                    filenum = 0
-
-                    if plat_type == 'Linux':
-                        os.system('setterm -cursor off')
-                    for walker in os.walk(parent):
-                        try:
-                            remdir_create = os.path.normpath(os.path.join(
-                                remdirvar, walker[0])).replace('\\', '/')
-                            pretty_remdir = (
-                                remdir_create[:20] + "..." + remdir_create[-35:]) if len(remdir_create) > term_width - 15 else remdir_create
-                            remdir_creation = f"Creating {p_}{pretty_remdir}{_nc}=>"
-                            print(remdir_creation + " "
-                                  * (term_width - len(remdir_creation) - 1))
-                            sftpc.mkdir(os.path.normpath(os.path.join(
-                                remdirvar, walker[0])).replace('\\', '/'))
-                            dirnum += 1
-                        except Exception as e:
-                            print(f"{r_}Can't create dir{_nc} {p_}{pretty_remdir}{_nc}{r_}; already exists or bad permissions{_nc}")
-                            print("")
-
-                        for file in walker[2]:
-                            print(f"Transferring: {g_}{file}{_nc}", end="\r")
-                            transferprog = f"Transferring: {g_}{file}{_nc}"
-                            print(transferprog + " " * (term_width
-                                                        - len(transferprog) - 1), end="\r")
-                            sftpc.put(os.path.normpath(os.path.join(walker[0], file)).replace(
-                                '\\', '/'), os.path.join(remdirvar, walker[0], file).replace('\\', '/'))
-                            filenum += 1
-                    if plat_type == 'Linux':
-                        os.system('setterm -cursor on')
-                    sftpc.close()
-                    print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files.")
-
-                except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType):
-                    print(f"""
-{r_}<ERROR>
-Username, password, or SSH key are incorrect, or the server is not accepting the type of authentication attempted{_nc}.\n""")
-                    input("Press a key to continue...")
-                    print(" ")
-                    return
-                except (BlockingIOError, socket.timeout):
-                    print(f"""
-{r_}<ERROR>
-Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
-                    input("Press a key to continue...")
-                    print(" ")
-                    return
-                except (Exception, IOError) as e:
-                    print(f"""
-{r_}<ERROR>
-The server raised an exception: {e} {_nc}\n""")
-                    input("Press a key to continue...")
-                    print(" ")
-                    return
 
+        # Upload to each SFTP, SCP and SMB destination, with retries and a result table at the end
+        asyncfunc = (lambda conn, dest: asyncDirUpload(conn, dest, dirvar, remdirvar)) if asyncBackend(True) else None
+        mpfuFanout(dests, lambda dest: dirUploadDest(dest, dirvar, remdirvar), asyncfunc)
+
+
+# Run a command on every destination, --parallel at a time (or in waves, see rollout), collecting output instead of
+# echoing it. Returns a list of (dest, exit code, stdout, stderr) tuples in serverlist order. Exit code is None if
+# the host could not be reached, or was skipped when the rollout stopped, with the reason in stderr.
+def sshFanout(dests, cmdvar):
+    results = [None] * len(dests)
+    useasync = asyncBackend()
+
+    def execWorker(dest):
+        threadstate.quiet = True
+        protvar, servvar, _, uservar, passvar = dest
+        # Only connecting is retried: a command that failed part way may not be safe to run again
+        pssh, error = retryCall(dest, lambda: sshpool.connect(servvar, uservar, passvar))
+        if pssh is None:
+            return dest, None, "", str(error) or type(error).__name__
+        try:
+            rc, stdout, stderr = sshpool.run(servvar, uservar, passvar, cmdvar, echo=False)
+        except Exception as e:
+            rc, stdout, stderr = None, "", str(e) or type(e).__name__
+        return dest, rc, stdout, stderr
+
+    def runWave(positions, workers):
+        for i in positions:
+            if i in skip:
+                results[i] = (dests[i], None, "", skip[i])
+        run = [i for i in positions if i not in skip]
+        wave = [dests[i] for i in run]
+        if useasync:
+            waveresults = [(dest, *(result or (None, "", err))) for dest, result, _, err in
+                           asyncFanout(wave, lambda conn, dest: asyncExec(conn, dest, cmdvar), workers, rerun=False)]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                waveresults = list(pool.map(execWorker, wave))
+        for i, result in zip(run, waveresults):
+            results[i] = result
+        return len([i for i in positions if results[i][1] != 0])
+
+    start = time.monotonic()
+    # Commands run over SSH whatever protocol the serverlist entry names, so that is the login to warm up
+    skip = preflight([("ssh",) + dest[1:] for dest in dests], ("ssh",) if useasync else ())
+    if wavesOn():
+        print(f"\nRunning {y_}{cmdvar}{_nc} on {y_}{len(dests)}{_nc} hosts in waves =>")
+    else:
+        print(f"\nRunning {y_}{cmdvar}{_nc} on {y_}{len(dests)}{_nc} hosts, {y_}{max(1, args.parallel)}{_nc} at a time =>\n")
+    for i in rollout(dests, runWave):
+        results[i] = (dests[i], None, "", rollout_stopped)
+    execSummary(results, time.monotonic() - start)
+    return results
+
+# Print command results with hosts that produced identical output merged, failing hosts first
+def execSummary(results, elapsed):
+    groups = {}
+    for dest, rc, stdout, stderr in results:
+        groups.setdefault((rc, stdout, stderr), []).append(dest[1])
+
+    # Unreachable hosts, then non-zero exits, then hosts a stopped rollout skipped, then successes; larger groups
+    # first within each
+    rank = lambda rc, stderr: 2 if stderr == rollout_stopped else 0 if rc is None else 1 if rc != 0 else 3
+    for (rc, stdout, stderr), hosts in sorted(groups.items(), key=lambda g: (rank(g[0][0], g[0][2]), -len(g[1]))):
+        if stderr == rollout_stopped:
+            print(f"{bld_}[{_nc}{y_}SKIPPED{_nc}{bld_}]{_nc} {y_}{len(hosts)}{_nc} host(s): {b_}{', '.join(hosts)}{_nc}\n")
+            continue
+        if rc is None:
+            status = f"{r_}UNREACHABLE{_nc}"
+        elif rc != 0:
+            status = f"{r_}EXIT {rc}{_nc}"
+        else:
+            status = f"{g_}OK{_nc}"
+        print(f"{bld_}[{_nc}{status}{bld_}]{_nc} {y_}{len(hosts)}{_nc} host(s): {b_}{', '.join(hosts)}{_nc}")
+        for line in stdout.rstrip("\n").split("\n") if stdout.strip() else []:
+            print(f"    {line}")
+        for line in stderr.rstrip("\n").split("\n") if stderr.strip() else []:
+            print(f"    {r_}{line}{_nc}")
+        print("")
+
+    skipped = len([r for r in results if r[3] == rollout_stopped])
+    failed = len([r for r in results if r[1] != 0]) - skipped
+    notrun = f", {y_}{skipped}{_nc} not run" if skipped else ""
+    print(f"{y_}{len(results) - failed - skipped}{_nc} succeeded, {r_ if failed else y_}{failed}{_nc} failed{notrun} in {y_}{elapsed:.1f}s{_nc}\n")
 
 def mpfuSSH():
-    import fabric
-    import fabric.exceptions
-
     # Load in previous connections for tab completion
     _, lastserv_f = lastServ()
     t.createListCompleter(lastserv_f)
@@ -1120,45 +3267,16 @@ If you wish to issue commands to multiple machines, provide a serverlist when ru
                 login_prompt = f"\nEnter user and server for command ({y_}username@server.address.net{_nc}): "
                 ssh_prompt = input(login_prompt).strip()
                 uservar, servvar = ssh_prompt.split('@')[0], ssh_prompt.split('@')[1]
-                conn = fabric.Connection(servvar, user=uservar)
 
                 with open(os.path.join(homepath, 'sav.mpfu'), 'a') as lastserv_u:
                     lastserv_u.write('\n' + servvar)
 
                 try:
-                    conn.open()
-                except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-                    print(
-                        f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
-                    passvar = getpass.getpass('')
-
-                    passauth_conn = fabric.Connection(servvar, user=uservar, connect_kwargs={
-                                                  "password": passvar})
-
-                    passauth_conn.open()
-
-                    passauthloop = 1
-                    while passauthloop == 1:
-                        print(f"\nConnecting to {b_}{servvar}{_nc} =>", end="")
-                        cmdvar = input(
-                            "\nEnter command to run on server (Ctrl-D to return to menu): ")
-                        print(" ")
-                        cmdresult = passauth_conn.run(cmdvar)
-
-                        # Create list of cmd output lines, append them to buffer each cmd, and deduplicate
-                        outputlist = [c for c in cmdresult.stdout.split("\n")]
-                        bufferlist.extend(outputlist)
-                        bufferset = set(bufferlist)
-
-                        t.createListCompleter(bufferset)
-                        readline.set_completer(t.listCompleter)
-
-                        print(" ")
+                    sshpool.connect(servvar, uservar)
                 except socket.gaierror as e:
                     print(f"{r_}The command returned an error{_nc}: {e}")
                     continue
 
-
                 cmdloop = 1
                 while cmdloop == 1:
                     try:
@@ -1166,10 +3284,12 @@ If you wish to issue commands to multiple machines, provide a serverlist when ru
                         cmdvar = input(
                             "\nEnter command to run on server (Ctrl-D to return to menu): ")
                         print(" ")
-                        cmdresult = conn.run(cmdvar)
+                        rc, stdout, _ = sshpool.run(servvar, uservar, None, cmdvar)
+                        if rc != 0:
+                            print(f"{r_}The command returned an error{_nc}: exit code {rc}\n")
 
                         # Create list of cmd output lines, append them to buffer each cmd, and deduplicate
-                        outputlist = [c for c in cmdresult.stdout]
+                        outputlist = [c for c in stdout.split("\n")]
                         bufferlist.extend(outputlist)
                         bufferset = set(bufferlist)
 
@@ -1184,40 +3304,37 @@ If you wish to issue commands to multiple machines, provide a serverlist when ru
         except EOFError:
             pass
     elif args.list:
+        dests = [d for d in listDests() if d[0] != "s3"]
         cmdvar = input(
             "\nEnter command to run on servers in list (Ctrl-D to return to menu): ")
-        with open(args.list, 'r') as serv_file:
-            ufile_input = serv_file.read()
-            sfile_input = ufile_input.strip()
-
-            # Loop through input list and parse into variables
-            split_input = sfile_input.split("\n")
-            for e in range(len(split_input)):
-                pop_input = split_input.pop()
-                elem = pop_input.split(":")
-                protvar = elem[0].strip()
-                if protvar != "s3":
-                    servvar = elem[1].strip()
-                    remdirvar = elem[2].strip()
-                    uservar = elem[3].strip()
-                    passvar = elem[4].strip()
-                if protvar == "s3":
-                    continue
+
+        # With --parallel or waves, run on several hosts at once and print a grouped summary
+        if args.parallel > 1 or wavesOn():
+            sshFanout(dests, cmdvar)
+            input("Press a key to return to the menu...")
+            print(" ")
+            return
+
+        # Loop through input list and run the command on each host
+        for dest in dests:
+            protvar, servvar, remdirvar, uservar, passvar = dest
+            try:
+                print(f"\nConnecting to {b_}{servvar}{_nc} =>")
+                print(" ")
+                rc, _, _ = sshpool.run(servvar, uservar, passvar, cmdvar)
+                if rc != 0:
+                    print(f"{r_}The command returned an error{_nc}: exit code {rc}\n")
+                print(" ")
+                input("Press a key to continue (Ctrl-D to return to menu)...")
+            except EOFError:
+                break
+            except Exception as e:
+                print(f"{r_}The command returned an error{_nc}: {e}\n")
                 try:
-                    print(f"\nConnecting to {b_}{servvar}{_nc} =>")
-                    print(" ")
-                    cmdresult = fabric.Connection(servvar, user=uservar, connect_kwargs={
-                                                  "password": passvar}).run(cmdvar)
-                    print(" ")
                     input("Press a key to continue (Ctrl-D to return to menu)...")
                 except EOFError:
                     break
-                except Exception as e:
-                    print(f"{r_}The command returned an error{_nc}: {e}\n")
-                    try:
-                        input("Press a key to continue (Ctrl-D to return to menu)...")
-                    except EOFError:
-                        break
+
 # MPFU menu function
 def mpfuMenu():
 
@@ -1239,7 +3356,7 @@ def mpfuMenu():
  1) Upload local files to {y_}one{_nc} destination (server, share, bucket, etc.)
  2) Upload local files to {y_}multiple{_nc} destinations from manual INPUT
  3) Upload local files to {y_}multiple{_nc} destinations from a {y_}list{_nc} entered at CLI (mpfu -l serverlist.txt)
- 4) Upload a {y_}directory{_nc} recursively (all subdirectories and files) to one or more destinations (SFTP only)\n
+ 4) Upload a {y_}directory{_nc} recursively (all subdirectories and files) to one or more destinations (SFTP, SCP, SMB)\n
 
  {bld_}|Control|{_nc}
 
@@ -1263,17 +3380,85 @@ def mpfuMenu():
         mpfuSSH()
     elif choicevar == "q" or choicevar == "Q":
         print("\n")
+        sshpool.closeAll()
+        ftppool.closeAll()
+        smbpool.closeAll()
         sys.exit()
     else:
         print(f"\n{r_}Not an option!{_nc}")
-metaloop = 1
-while metaloop == 1:
+
+    # Slowest hosts and metrics files for whatever ran from this menu choice
+    metrics.report()
+
+# Destinations for a headless run, from --list and/or --dest
+def headlessDests():
+    fast_hosts.clear()
+    dests = listDests() if args.list else []
+    if args.dest:
+        dests.extend(parseDests(args.dest))
+    return dests
+
+# Run a headless subcommand without the menu or any prompts. Returns the process exit code.
+def mpfuHeadless():
+    global headless
+    headless = True
+
     try:
-        menuloop = 1
-        while menuloop == 1:
-            try:
-                mpfuMenu()
-            except EOFError:
-                pass
-    except Exception as e:
-        print(f"{r_}An exception occurred: {e}{_nc}")
+        dests = headlessDests()
+    except (IOError, IndexError, ValueError) as e:
+        print(f"{r_}<ERROR> Could not read serverlist: {e}{_nc}")
+        return 2
+    # Directory upload is SFTP, SCP and SMB only, and commands can't be run on S3 buckets
+    if args.command == "dir":
+        dests = [d for d in dests if d[0] in ("sftp", "scp", "smb")]
+    elif args.command == "exec":
+        dests = [d for d in dests if d[0] != "s3"]
+    if not dests:
+        print(f"{r_}<ERROR> No usable destinations given.{_nc} Provide a serverlist with {y_}--list{_nc} or destinations with {y_}--dest{_nc}.")
+        return 2
+
+    if args.command == "upload":
+        fileglob = []
+        for pattern in args.files:
+            fileglob.extend(sorted(glob.glob(os.path.expanduser(pattern))))
+        fileglob = [g for g in fileglob if os.path.isfile(g)]
+        if not fileglob:
+            print(f"{r_}<ERROR> No local files match{_nc} {y_}{' '.join(args.files)}{_nc}")
+            return 2
+        dirvar = os.path.dirname(fileglob[0])
+        filevar = " ".join(args.files)
+        relay = s3Relay(dests)
+        results = mpfuFanout(dests, lambda dest: uploadDest(dest, dirvar, filevar, fileglob, relay),
+                             asyncUploadFunc(fileglob))
+    elif args.command == "dir":
+        if not os.path.isdir(args.local):
+            print(f"{r_}<ERROR> Local directory{_nc} {y_}{args.local}{_nc} {r_}does not exist{_nc}")
+            return 2
+        asyncfunc = (lambda conn, dest: asyncDirUpload(conn, dest, args.local, args.remote)) if asyncBackend(True) else None
+        results = mpfuFanout(dests, lambda dest: dirUploadDest(dest, args.local, args.remote), asyncfunc)
+    elif args.command == "exec":
+        execresults = sshFanout(dests, " ".join(args.cmd))
+        return 0 if all(rc == 0 for _, rc, _, _ in execresults) else 1
+
+    return 0 if all(ok for _, ok, _, _ in results) else 1
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.command:
+        exitcode = mpfuHeadless()
+        sshpool.closeAll()
+        ftppool.closeAll()
+        smbpool.closeAll()
+        sys.exit(exitcode)
+
+    metaloop = 1
+    while metaloop == 1:
+        try:
+            menuloop = 1
+            while menuloop == 1:
+                try:
+                    mpfuMenu()
+                except EOFError:
+                    pass
+        except Exception as e:
+            print(f"{r_}An exception occurred: {e}{_nc}")